@@ -4,10 +4,6 @@ import logging.config
 import os
 from pathlib import Path
 
-from flask import Flask
-
-from server import server
-
 PROJECT_ROOT = Path(os.path.realpath(__file__)).parents[1]
 ASSETS_DIR = PROJECT_ROOT / "Assets"
 
@@ -37,6 +33,10 @@ def setup_logging(path=os.path.join(ASSETS_DIR, 'logging.json'),
 
 
 def create_app(config=None):
+    # imported here so that the parser and the CLI tools don't load the web stack
+    from flask import Flask
+    from server import server
+
     # Flask
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_object(config if config else 'config')
@@ -1,74 +1,173 @@
-import json
+import io
+import os
+from functools import cached_property
+from multiprocessing import Pool
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 from models import Campaign, START_DATE
+from render import MapRenderer
+from timeline import Timeline, write as write_timeline
 from src import ASSETS_DIR
 from util import get_date, timing
 
+LEGEND_MARGIN = 10
+
 
 class Analyzer:
+    """Assets are loaded on first use, so that creating an Analyzer costs nothing for the workers that don't draw"""
+
     def __init__(self):
-        with open(f"{ASSETS_DIR}/province_coordinates.json") as f:
-            self.province_coordinates = json.load(f)
-        self.map_img = Image.open(f"{ASSETS_DIR}/provinces_bordered.png")
-        self.map_img_pixels = np.array(self.map_img)
-        self.font = ImageFont.truetype('/usr/share/fonts/truetype/freefont/FreeSans.ttf', 15, encoding='unic')
         # todo load config here for drawing, etc
         self.campaign = None
 
+    @cached_property
+    def renderer(self):
+        return MapRenderer()
+
+    @cached_property
+    def font(self):
+        return ImageFont.truetype('/usr/share/fonts/truetype/freefont/FreeSans.ttf', 15, encoding='unic')
+
     def analyze(self, campaign):
         self.campaign = campaign
         self.draw_conquest_heat_map()
 
-    @timing
-    def draw_conquest_heat_map(self, country=None, crop_margin=50, resize_ratio=1.0, start_date=None, end_date=None):
-        # todo add support for multiplayer by drawing multiple countries in a single map
-        # fixme some provinces in the bharat file don't work properly, find why
-        country = self.campaign.get_country(country)
+    def heat_map_dates(self, campaign, start_date=None, end_date=None):
         start_date = get_date(start_date) if start_date else START_DATE
-        end_date = get_date(end_date) if end_date else self.campaign.current_date  # todo raise exception wrong date
+        end_date = get_date(end_date) if end_date else campaign.current_date  # todo raise exception wrong date
+        return start_date, end_date
+
+    @staticmethod
+    def conquest_colors(country, start_date, end_date):
+        """Returns the colors (province id -> rgb) of the provinces of country, by year of conquest"""
+        # fixme some provinces in the bharat file don't work properly, find why
         provinces = [p for p in country.owned_provinces if p.last_conquest <= end_date]
         spectrum = country.calculate_color_spectrum(n=end_date.year - start_date.year + 1)
-        id_to_color = {str(p.id): spectrum[max(p.last_conquest.year - start_date.year, 0)] for p in provinces}
-        width, height = self.map_img.size
-        pixels = self.map_img_pixels.copy()
-        e, n, w, s = 0, height, width, 0
-        for province_id, color in id_to_color.items():
-            for x, bands in self.province_coordinates[province_id].items():
-                x = int(x)
-                for y1, y2 in bands:
-                    pixels[x, y1:y2] = color
-                    e = max(e, min(y2 + crop_margin, width))
-                    w = min(w, max(y1 - crop_margin, 0))
-                n = min(n, max(x - crop_margin, 0))
-                s = max(s, min(x + crop_margin, height))
-        out = Image.fromarray(pixels)
-        if out.size[0] > 50 and crop_margin >= 0:
-            out = out.crop((w, n, e, s))
-            w, h = out.size
-            # draw legend
-            draw = ImageDraw.Draw(out)
-            draw.fontmode = '1'
-            margin, height = 10, 30
-            box_width = (w - 2 * margin)
-            # fixme test functioning for conquest after a single year on 3-color countries
-            if start_date.year != end_date.year:
-                spectrum = country.calculate_color_spectrum(n=box_width)
-                for i, c in enumerate(spectrum):
-                    draw.rectangle([(margin + i, h - margin - height), (margin + i + 1, h - margin)], fill=c)
-                draw.rectangle([(margin, h - margin - height), (w - margin, h - margin)], outline="black", width=1)
+        return {p.id: spectrum[max(p.last_conquest.year - start_date.year, 0)] for p in provinces}
+
+    @staticmethod
+    def legend(country, start_date, end_date, width, label=None):
+        """Returns the legend of country for a map that is width pixels wide, drawn by draw_map"""
+        # fixme test functioning for conquest after a single year on 3-color countries
+        if start_date.year != end_date.year:
+            fill = country.calculate_color_spectrum(n=width - 2 * LEGEND_MARGIN)
+        else:
+            fill = country.colors[0]
+        return fill, start_date.year, end_date.year, label
+
+    def heat_map_job(self, countries, start_date, end_date, crop_margin, resize_ratio, output):
+        """Returns the arguments of draw_map for the heat map of the conquests of countries, all in the same map"""
+        colors = {}
+        for country in countries:
+            colors.update(self.conquest_colors(country, start_date, end_date))
+        job = {'colors': colors, 'box': None, 'legends': [], 'resize_ratio': resize_ratio, 'output': output}
+        if self.renderer.labels.shape[1] > 50 and crop_margin >= 0:
+            job['box'] = left, _, right, _ = self.renderer.crop_box(colors, crop_margin)
+            label = len(countries) > 1
+            job['legends'] = [self.legend(c, start_date, end_date, right - left, str(c) if label else None)
+                              for c in countries]
+        return job
+
+    def draw_map(self, colors, box=None, legends=(), resize_ratio=1.0, output=None):
+        """Renders colors in box and draws the legends at the bottom of the map, one above the other. The map is saved
+        in output, a path or a file object, or returned as PNG bytes when output is None."""
+        out = Image.fromarray(self.renderer.render(colors, box))
+        w, h = out.size
+        draw = ImageDraw.Draw(out)
+        draw.fontmode = '1'
+        margin, height, font_margin = LEGEND_MARGIN, 30, 8
+        for i, (fill, start_year, end_year, label) in enumerate(legends):
+            bottom = h - margin - i * (height + margin)
+            top = bottom - height
+            if isinstance(fill, list):
+                for j, c in enumerate(fill):
+                    draw.rectangle([(margin + j, top), (margin + j + 1, bottom)], fill=c)
+                draw.rectangle([(margin, top), (w - margin, bottom)], outline="black", width=1)
             else:
-                draw.rectangle([(margin, h - margin - height), (w - margin, h - margin)],
-                               outline="black", width=1, fill=country.colors[0])
-            font_margin = 8
-            draw.text((margin + font_margin, h - margin - height + font_margin),
-                      str(start_date.year), font=self.font, fill='white')
-            draw.text((w - margin - 42, h - margin - height + font_margin),
-                      str(end_date.year), font=self.font, fill='white')
+                draw.rectangle([(margin, top), (w - margin, bottom)], outline="black", width=1, fill=fill)
+            draw.text((margin + font_margin, top + font_margin), str(start_year), font=self.font, fill='white')
+            draw.text((w - margin - 42, top + font_margin), str(end_year), font=self.font, fill='white')
+            if label:
+                draw.text((w // 2 - 12, top + font_margin), label, font=self.font, fill='white')
         out = out.resize(np.array(out.size) * resize_ratio, Image.BILINEAR)
-        out.save(f"{ASSETS_DIR}/heatmap.png")
+        if output is None:
+            buffer = io.BytesIO()
+            out.save(buffer, format='PNG')
+            return buffer.getvalue()
+        out.save(output, format='PNG')
+        return output
+
+    @timing
+    def draw_conquest_heat_map(self, country=None, crop_margin=50, resize_ratio=1.0, start_date=None, end_date=None,
+                               output=None):
+        """Draws the heat map of the conquests of country (the player by default) in output, which defaults to
+        heatmap_<tag>.png in the assets"""
+        country = self.campaign.get_country(country)
+        start_date, end_date = self.heat_map_dates(self.campaign, start_date, end_date)
+        output = output or f"{ASSETS_DIR}/heatmap_{country.tag}.png"
+        return self.draw_map(**self.heat_map_job([country], start_date, end_date, crop_margin, resize_ratio, output))
+
+    @timing
+    def draw_heat_maps(self, countries=None, campaign=None, combined=False, crop_margin=50, resize_ratio=1.0,
+                       start_date=None, end_date=None, output_dir=None, workers=os.cpu_count()):
+        """Draws the heat maps of the conquests of countries (tags, all the analyzed countries by default), one per
+        country or a single one with all of them when combined. Maps are drawn across a pool of workers that share the
+        rasters of the renderer, and are saved as heatmap_<tags>.png in output_dir or returned as PNG bytes when
+        output_dir is None. Returns a dict of the tags of each map, joined by '-', to its path or bytes."""
+        campaign = campaign or self.campaign
+        if countries:
+            countries = [campaign.get_country(c) for c in countries]
+        else:  # countries that weren't analyzed still have the raw province ids
+            countries = [c for c in campaign.countries.values()
+                         if isinstance(getattr(c, 'owned_provinces', None), list)]
+        start_date, end_date = self.heat_map_dates(campaign, start_date, end_date)
+        groups = [countries] if combined else [[c] for c in countries]
+        names = ['-'.join(c.tag for c in group) for group in groups]
+        jobs = [self.heat_map_job(group, start_date, end_date, crop_margin, resize_ratio,
+                                  f"{output_dir}/heatmap_{name}.png" if output_dir else None)
+                for name, group in zip(names, groups)]
+        if workers <= 1 or len(jobs) <= 1:
+            return dict(zip(names, (self.draw_map(**job) for job in jobs)))
+        blocks, spec = self.renderer.share()
+        try:
+            with Pool(min(workers, len(jobs)), initializer=init_worker, initargs=(spec,)) as pool:
+                return dict(zip(names, pool.map(draw_job, jobs)))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    @timing
+    def draw_conquest_timeline(self, country=None, crop_margin=50, resize_ratio=1.0, start_date=None, end_date=None,
+                               step=1, duration=100, fmt='gif', output=None):
+        """Draws the animation of the conquests of country (the player by default), one frame every step years, as a
+        gif, apng or webp. Frames are encoded as they're drawn into output, a path or a file object, which defaults to
+        timeline_<tag>.<fmt> in the assets."""
+        country = self.campaign.get_country(country)
+        start_date, end_date = self.heat_map_dates(self.campaign, start_date, end_date)
+        timeline = Timeline(self.renderer, country, start_date, end_date, self.font, crop_margin, resize_ratio, step)
+        output = output or f"{ASSETS_DIR}/timeline_{country.tag}.{fmt}"
+        if hasattr(output, 'write'):
+            write_timeline(timeline, output, fmt, duration)
+        else:
+            with open(output, 'wb') as f:
+                write_timeline(timeline, f, fmt, duration)
+        return output
+
+
+worker_analyzer = None  # analyzer of a pool worker, drawing over the rasters shared by the parent
+
+
+def init_worker(spec):
+    global worker_analyzer
+    worker_analyzer = Analyzer()
+    worker_analyzer.renderer = MapRenderer.attach(spec)
+
+
+def draw_job(job):
+    return worker_analyzer.draw_map(**job)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+import argparse
+import glob
+import json
+import os
+import time
+import traceback
+from multiprocessing import Pool
+
+from parser import Parser
+
+
+def find_saves(patterns):
+    """Expands directories (searched recursively for .eu4 files) and glob patterns into a list of files"""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.eu4')
+        files.update(f for f in glob.glob(pattern, recursive=True) if os.path.isfile(f))
+    return sorted(files)
+
+
+def output_path(filename):
+    return f"{os.path.splitext(filename)[0]}.json"
+
+
+def file_size(filename):
+    """Size of filename, 0 if it was removed or can't be read"""
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def is_parsed(filename):
+    """Whether the JSON of filename exists and is newer than it"""
+    try:
+        return os.path.getmtime(output_path(filename)) >= os.path.getmtime(filename)
+    except OSError:
+        return False
+
+
+def parse_save(filename):
+    """Worker task: parses filename and writes the result next to it. Errors are returned instead of raised, so that a
+    broken save doesn't stop the batch."""
+    start, size = time.perf_counter(), 0
+    try:
+        size = os.path.getsize(filename)
+        d = Parser.from_zip(filename, mode='buffer')  # buffer mode, pool workers can't start the parser pool
+        with open(output_path(filename), 'w') as f:
+            json.dump(d, f)
+        error = None
+    except Exception:
+        error = traceback.format_exc(limit=3)
+    return filename, size, time.perf_counter() - start, error
+
+
+def init_worker():
+    Parser(stream=None)  # loads keys and whitelist once per worker
+
+
+def run(files, workers=os.cpu_count(), tasks_per_worker=None, skip_existing=False):
+    """Parses files across a pool of workers, printing the throughput of every file and of the whole batch. Returns
+    the list of files that failed, including the ones removed before they were parsed. Bigger files are sent first so
+    that the pool doesn't wait on one at the end."""
+    if skip_existing:
+        files = [f for f in files if not is_parsed(f)]
+    files = sorted(files, key=file_size, reverse=True)
+    failed, total_size, total_time = [], 0, 0
+    start = time.perf_counter()
+    with Pool(processes=workers, initializer=init_worker, maxtasksperchild=tasks_per_worker) as pool:
+        for i, (filename, size, elapsed, error) in enumerate(pool.imap_unordered(parse_save, files), 1):
+            if error:
+                failed.append(filename)
+                print(f"[{i}/{len(files)}] {filename} failed after {elapsed:.2f}s\n{error}")
+                continue
+            total_size += size
+            total_time += elapsed
+            print(f"[{i}/{len(files)}] {filename}: {size / 2 ** 20:.2f}MB in {elapsed:.2f}s "
+                  f"({size / 2 ** 20 / elapsed:.2f}MB/s)")
+    wall = time.perf_counter() - start
+    parsed = len(files) - len(failed)
+    print(f"parsed {parsed} saves ({total_size / 2 ** 20:.2f}MB) in {wall:.2f}s with {workers} workers: "
+          f"{parsed / wall if wall else 0:.2f} saves/s, {total_size / 2 ** 20 / wall if wall else 0:.2f}MB/s, "
+          f"{total_time / wall if wall else 0:.2f}x parallelism, {len(failed)} failed")
+    return failed
+
+
+def main(args=None):
+    ap = argparse.ArgumentParser(description="Parses every save found in the given directories or glob patterns and "
+                                             "writes the result as JSON next to each save")
+    ap.add_argument('paths', nargs='+', help="directories or glob patterns of .eu4 files")
+    ap.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    ap.add_argument('-t', '--tasks-per-worker', type=int, default=None,
+                    help="saves parsed by a worker before it's replaced, to release its memory")
+    ap.add_argument('--skip-existing', action='store_true', help="skips saves whose JSON is newer than the save")
+    args = ap.parse_args(args)
+    if args.workers < 1:
+        ap.error("--workers must be at least 1")
+    if args.tasks_per_worker is not None and args.tasks_per_worker < 1:
+        ap.error("--tasks-per-worker must be at least 1")
+    failed = run(find_saves(args.paths), args.workers, args.tasks_per_worker, args.skip_existing)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exit(main())
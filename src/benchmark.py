@@ -0,0 +1,162 @@
+import argparse
+import io
+import json
+import os
+import resource
+import time
+import tracemalloc
+import zlib
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from parser import Parser, Tape
+from src import ASSETS_DIR
+
+BASELINE = f"{ASSETS_DIR}/benchmark_baseline.json"
+METRICS = ('seconds', 'peak_rss_mb', 'allocated_mb')  # compared with the baseline, lower is better
+
+
+def reset_peak_rss():
+    """Resets the peak RSS of the process so that it can be measured for a single phase (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Benchmark:
+    """Measures the phases of the processing of a save: zip inflate, tokenize (tape indexing), container build,
+    Campaign construction and heat map drawing. Parsing phases are also run on synthetic saves made by repeating the
+    content of the gamestate scale times. Every phase reports time, MB/s, tokens/s, peak RSS and, when allocations is
+    True, the peak of the memory allocated by Python measured with tracemalloc in a second run."""
+
+    def __init__(self, filename=f"{ASSETS_DIR}/dharma.eu4", scales=(1, 10), allocations=True):
+        self.filename = filename
+        self.scales = scales
+        self.allocations = allocations
+        self.results = {}
+
+    def measure(self, name, func, size=None, tokens=None):
+        """Runs func and stores its metrics under name. Errors are stored too, so that a phase that can't run in
+        this environment doesn't stop the others."""
+        reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            result = func()
+        except Exception as e:
+            self.results[name] = {'error': f"{type(e).__name__}: {e}"}
+            print(f"{name}: failed with {self.results[name]['error']}")
+            return None
+        seconds = time.perf_counter() - start
+        metrics = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+        if size:
+            metrics['mb_s'] = size / 2 ** 20 / seconds
+        if tokens:
+            metrics['tokens_s'] = tokens / seconds
+        if self.allocations:
+            tracemalloc.start()
+            func()
+            metrics['allocated_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        self.results[name] = metrics
+        print(f"{name}: " + ", ".join(f"{k}={v:.3f}" for k, v in metrics.items()))
+        return result
+
+    def run(self):
+        with ZipFile(self.filename) as zf:
+            meta, gamestate = zf.read('meta'), zf.read('gamestate')
+        for scale in self.scales:
+            buffer = gamestate if scale == 1 else b'EU4bin' + gamestate[6:] * scale
+            archive = self.compress(buffer)
+            suffix = f"@{scale}x"
+            buffer = self.measure(f"inflate{suffix}", lambda: ZipFile(archive).read('gamestate'), size=len(buffer))
+            tape = self.measure(f"tokenize{suffix}", lambda: Tape.from_buffer(buffer, offset=6), size=len(buffer))
+            tokens = len(tape) if tape is not None else None
+            if tokens:
+                self.results[f"tokenize{suffix}"]['tokens_s'] = tokens / self.results[f"tokenize{suffix}"]['seconds']
+            container = self.measure(f"build{suffix}", lambda: self.build(buffer), size=len(buffer), tokens=tokens)
+            del archive, tape
+            if scale == 1:
+                gameinfo = {"meta": Parser(stream=None, whitelist=False, mode='buffer').decode(memoryview(meta), 6),
+                            "gamestate": container}
+                campaign = self.measure("campaign", lambda: self.campaign(gameinfo))
+                if campaign is not None:
+                    self.measure("heatmap", lambda: self.heatmap(campaign))
+        return self.results
+
+    @staticmethod
+    def compress(buffer):
+        archive = io.BytesIO()
+        with ZipFile(archive, 'w', ZIP_DEFLATED, compresslevel=zlib.Z_BEST_SPEED) as zf:
+            zf.writestr('gamestate', buffer)
+        archive.seek(0)
+        return archive
+
+    @staticmethod
+    def build(buffer):
+        return Parser(stream=None, mode='buffer').decode(memoryview(buffer), 6)
+
+    @staticmethod
+    def campaign(gameinfo):
+        from models import Campaign
+        return Campaign(gameinfo)
+
+    @staticmethod
+    def heatmap(campaign):
+        from analyzer import Analyzer
+        analyzer = Analyzer()
+        analyzer.campaign = campaign
+        analyzer.draw_conquest_heat_map()
+
+
+def compare(results, baseline, threshold=0.2):
+    """Returns the (phase, metric, baseline, value) of the metrics that regressed by more than threshold"""
+    regressions = []
+    for phase, metrics in results.items():
+        for metric in METRICS:
+            old, new = baseline.get(phase, {}).get(metric), metrics.get(metric)
+            if old and new is not None and new > old * (1 + threshold):
+                regressions.append((phase, metric, old, new))
+    return regressions
+
+
+def main(args=None):
+    ap = argparse.ArgumentParser(description="Benchmarks the parsing and rendering phases and compares the results "
+                                             "with a baseline")
+    ap.add_argument('--save', default=f"{ASSETS_DIR}/dharma.eu4", help="save file used for the benchmark")
+    ap.add_argument('--scales', default='1,10', help="comma separated sizes of the synthetic saves")
+    ap.add_argument('--baseline', default=BASELINE, help="JSON file of the baseline results")
+    ap.add_argument('--save-baseline', action='store_true', help="stores the results as the new baseline")
+    ap.add_argument('--threshold', type=float, default=0.2, help="relative regression that makes the run fail")
+    ap.add_argument('--no-allocations', action='store_true', help="skips the tracemalloc runs")
+    args = ap.parse_args(args)
+    benchmark = Benchmark(args.save, tuple(int(s) for s in args.scales.split(',')), not args.no_allocations)
+    results = benchmark.run()
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved in {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline found in {args.baseline}, run with --save-baseline first")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for phase, metric, old, new in regressions:
+        print(f"REGRESSION {phase} {metric}: {old:.3f} -> {new:.3f} (+{(new / old - 1) * 100:.0f}%)")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,126 @@
+import hashlib
+import mmap
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from lazy import LazySave
+from metrics import metrics
+from src import ASSETS_DIR
+
+VERSION = 2  # bump when the format of the entries or the meaning of the tokens changes
+
+
+class SaveCache:
+    """Content-addressed cache of parsed saves. Entries are keyed by the hash of the .eu4 file together with the cache
+    version and the key and whitelist files, and contain the decompressed content of the save, with plaintext saves
+    already converted to binary tokens, and the structural tokens of its top levels (<entry>.<lazy depth>.npz). They're
+    loaded through mmap, so a hit returns a LazySave without inflating or scanning anything and only the objects that
+    are accessed are decoded. The least recently used entries are evicted when the directory exceeds max_size
+    bytes."""
+    chunk_size = 1 << 20
+
+    def __init__(self, directory=f"{ASSETS_DIR}/cache", max_size=2 ** 30):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+        self.salt = self.get_salt()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def get_salt():
+        h = hashlib.sha256(str(VERSION).encode())
+        for name in ('keys.txt', 'keys_whitelist.csv'):
+            with open(f"{ASSETS_DIR}/{name}", 'rb') as f:
+                h.update(f.read())
+        return h.digest()
+
+    def key(self, filename):
+        h = hashlib.sha256(self.salt)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def load(self, filename, lazy_depth=2):
+        """Returns the LazySave of filename, parsing and storing it in the cache on a miss"""
+        key = self.key(filename)
+        save = self.get(key, filename, lazy_depth)
+        if save is not None:
+            self.hits += 1
+            metrics.count('cache_hits')
+            return save
+        self.misses += 1
+        metrics.count('cache_misses')
+        save = LazySave(filename, lazy_depth=lazy_depth)
+        self.put(key, save)
+        return save
+
+    def get(self, key, filename=None, lazy_depth=2):
+        """Returns the LazySave of the entry key, or None if it's missing, also when another process evicts it while
+        it's opened"""
+        path = os.path.join(self.directory, key)
+        buffers, tokens = {}, {}
+        try:
+            os.utime(path)  # marks the entry as recently used
+            for name in LazySave.entries:
+                with open(os.path.join(path, f"{name}.bin"), 'rb') as f:
+                    buffers[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                index = os.path.join(path, f"{name}.{lazy_depth}.npz")
+                if os.path.exists(index):  # entries of empty objects or stored with another depth have none
+                    with np.load(index) as f:
+                        tokens[name] = (f['offsets'], f['codes'], f['depths'])
+        except OSError:
+            return None
+        return LazySave(filename, lazy_depth=lazy_depth, buffers=buffers, tokens=tokens)
+
+    def put(self, key, save):
+        """Stores the buffers of save and their structural tokens. The entry is written in a temporary directory and
+        renamed, so that concurrent readers never see it partially written."""
+        path = os.path.join(self.directory, key)
+        tmp = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        try:
+            for name in LazySave.entries:
+                with open(os.path.join(tmp, f"{name}.bin"), 'wb') as f:
+                    f.write(save.view(name))
+                tokens = save.structure(name)
+                if tokens is not None:
+                    offsets, codes, depths = tokens
+                    np.savez(os.path.join(tmp, f"{name}.{save.lazy_depth}.npz"), offsets=offsets, codes=codes,
+                             depths=depths)
+            os.rename(tmp, path)
+        except OSError:  # another process stored the same entry in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """Returns (last access, size, path) of the stored entries"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except OSError:  # evicted by another process
+                continue
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_size:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+
+from models import Province
+from util import get_date, timing
+
+# (column, dtype, path inside the object) of the exported fields. Strings are stored as int16 indexes in a dictionary
+# (tags share the 'tags' dictionary), missing values are -1 for indexes and NaN for floats.
+PROVINCE_COLUMNS = [
+    ('owner', 'tag', ('owner',)),
+    ('controller', 'tag', ('controller',)),
+    ('base_tax', np.float32, ('base_tax',)),
+    ('base_production', np.float32, ('base_production',)),
+    ('base_manpower', np.float32, ('base_manpower',)),
+    ('devastation', np.float32, ('devastation',)),
+    ('trade_goods', 'str', ('trade_goods',)),
+    ('name', 'str', ('name',)),
+]
+COUNTRY_COLUMNS = [
+    ('human', np.bool_, ('human',)),
+    ('was_human', np.bool_, ('was_human',)),
+    ('primary_culture', 'str', ('primary_culture',)),
+    ('religion', 'str', ('religion',)),
+    ('capital', np.int32, ('capital',)),
+    ('trade_port', np.int32, ('trade_port',)),
+    ('development', np.float32, ('development',)),
+    ('raw_development', np.float32, ('raw_development',)),
+    ('adm_tech', np.int16, ('technology', 'adm_tech')),
+    ('dip_tech', np.int16, ('technology', 'dip_tech')),
+    ('mil_tech', np.int16, ('technology', 'mil_tech')),
+    ('prestige', np.float32, ('prestige',)),
+    ('stability', np.float32, ('stability',)),
+    ('treasury', np.float32, ('treasury',)),
+    ('inflation', np.float32, ('inflation',)),
+    ('estimated_monthly_income', np.float32, ('estimated_monthly_income',)),
+    ('army_tradition', np.float32, ('army_tradition',)),
+    ('navy_tradition', np.float32, ('navy_tradition',)),
+    ('great_power_score', np.float32, ('great_power_score',)),
+    ('innovativeness', np.float32, ('innovativeness',)),
+]
+MISSING = {np.float32: np.nan, np.bool_: False}
+EVENT_DTYPE = [('date', np.int32), ('province', np.int32), ('owner', np.int16)]  # owner changes, dates as ordinals
+
+
+class Columns:
+    """Column-oriented copy of the provinces and countries of a save, made of NumPy structured arrays. Tags and other
+    strings are dictionary encoded, so that filters and aggregations over all the provinces can be vectorized, e.g.
+    columns.provinces['development'][columns.owned_by('SWE')].sum(). The owner changes found in the history of the
+    provinces are in events, sorted by date. Arrays are saved as .npy files that can be loaded with mmap."""
+
+    def __init__(self, provinces, countries, dictionaries, events=None):
+        self.provinces = provinces
+        self.countries = countries
+        self.events = events if events is not None else np.zeros(0, dtype=EVENT_DTYPE)
+        self.dictionaries = dictionaries  # column -> array of strings, tags are in 'tags'
+        self.tag_indexes = {tag: i for i, tag in enumerate(dictionaries['tags'])}
+
+    @classmethod
+    @timing
+    def from_gamestate(cls, gamestate):
+        dictionaries = {'tags': {}}
+        countries = gamestate.get("countries", {})
+        provinces = gamestate.get("provinces", {})
+        for tag in countries:
+            dictionaries['tags'].setdefault(tag, len(dictionaries['tags']))
+        country_dtype = [('tag', np.int16)] + [(c, cls.column_dtype(t)) for c, t, _ in COUNTRY_COLUMNS] + \
+                        [('num_provinces', np.int32)]
+        country_rows = []
+        for tag, c in countries.items():
+            row = [dictionaries['tags'][tag]] + [cls.encode(c, t, path, dictionaries, name)
+                                                 for name, t, path in COUNTRY_COLUMNS]
+            row.append(len(c.get('owned_provinces', ())))
+            country_rows.append(tuple(row))
+        province_dtype = [('id', np.int32)] + [(c, cls.column_dtype(t)) for c, t, _ in PROVINCE_COLUMNS] + \
+                         [('development', np.float32), ('last_conquest', np.int32)]
+        province_rows, events = [], []
+        for key, p in provinces.items():
+            row = {name: cls.encode(p, t, path, dictionaries, name) for name, t, path in PROVINCE_COLUMNS}
+            development = np.nansum([row['base_tax'], row['base_production'], row['base_manpower']])
+            last_conquest = Province.get_last_conquest(p.get('history')).toordinal()
+            province_rows.append((abs(int(key)), *row.values(), development, last_conquest))
+            for date, owner in cls.owner_changes(p.get('history')):
+                tags = dictionaries['tags']
+                events.append((date.toordinal(), abs(int(key)), tags.setdefault(owner, len(tags))))
+        return cls(provinces=np.array(province_rows, dtype=province_dtype),
+                   countries=np.array(country_rows, dtype=country_dtype),
+                   dictionaries={k: np.array(list(d), dtype=np.str_) for k, d in dictionaries.items()},
+                   events=np.sort(np.array(events, dtype=EVENT_DTYPE), order=('date', 'province')))
+
+    @staticmethod
+    def owner_changes(history):
+        """Yields the (date, owner) of the dated entries of a province history that set its owner. Entries of the same
+        date are grouped in a '<date>s' container."""
+        if not isinstance(history, dict):  # no history -> uncolonized?
+            return
+        for key, value in history.items():
+            if not isinstance(key, str) or not key[:1].isnumeric():
+                continue
+            grouped = key.endswith('s') and isinstance(value, dict)
+            for entry in value.values() if grouped else (value,):
+                if isinstance(entry, dict) and isinstance(entry.get('owner'), str):
+                    yield get_date(key[:-1] if grouped else key), entry['owner']
+
+    @staticmethod
+    def column_dtype(t):
+        return np.int16 if t in ('tag', 'str') else t
+
+    @staticmethod
+    def encode(obj, t, path, dictionaries, column):
+        try:
+            for k in path:
+                obj = obj[k]
+        except (KeyError, TypeError):
+            obj = None
+        if obj is None or isinstance(obj, dict):
+            return MISSING.get(t, -1)
+        if t == 'tag':
+            return dictionaries['tags'].setdefault(obj, len(dictionaries['tags']))
+        if t == 'str':
+            d = dictionaries.setdefault(column, {})
+            return d.setdefault(obj, len(d))
+        return obj
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "provinces.npy"), self.provinces)
+        np.save(os.path.join(directory, "countries.npy"), self.countries)
+        np.save(os.path.join(directory, "events.npy"), self.events)
+        np.savez(os.path.join(directory, "dictionaries.npz"), **self.dictionaries)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with np.load(os.path.join(directory, "dictionaries.npz")) as f:
+            dictionaries = {k: f[k] for k in f.files}
+        events = os.path.join(directory, "events.npy")
+        return cls(provinces=np.load(os.path.join(directory, "provinces.npy"), mmap_mode=mmap_mode),
+                   countries=np.load(os.path.join(directory, "countries.npy"), mmap_mode=mmap_mode),
+                   dictionaries=dictionaries,
+                   events=np.load(events, mmap_mode=mmap_mode) if os.path.exists(events) else None)
+
+    def decode(self, column, values):
+        """Returns the strings of the dictionary encoded values of a column"""
+        return self.dictionaries['tags' if column in ('tag', 'owner', 'controller') else column][values]
+
+    def owned_by(self, tag):
+        """Boolean mask of the provinces owned by tag"""
+        return self.provinces['owner'] == self.tag_indexes.get(tag, -2)
+
+    def development_by_owner(self):
+        """Total development of the provinces of every tag, indexed like the 'tags' dictionary"""
+        owners = self.provinces['owner']
+        owned = owners >= 0
+        return np.bincount(owners[owned], weights=self.provinces['development'][owned],
+                           minlength=len(self.dictionaries['tags']))
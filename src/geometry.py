@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src import ASSETS_DIR
+
+# (first zoom, simplification tolerance in map pixels) of the levels of detail. At zoom z a pixel of the screen is 2^-z
+# pixels of the map, so coarser levels are simplified more without visible changes.
+LEVELS = ((-2, 4), (0, 1), (2, 0.25), (4, 0))
+GRID = 256  # bounds are extended to multiples of GRID, so that close views share the same clipped payload
+
+
+class GeometryPayload:
+    """Province geometry served to the map: the GeoJSON made by scripts.find_polygons converted to a quantized TopoJSON,
+    where the borders shared by two provinces are stored once, and gzipped once. The payload is cached on disk next to
+    the source and rebuilt when the source changes. The etag is the hash of the payload.
+    With a tolerance, the arcs of the topology are simplified: since neighbouring provinces share the arcs of their
+    border, they stay consistent. clipped returns payloads with only the provinces that intersect some bounds."""
+    max_clipped = 64  # clipped payloads kept in memory
+
+    def __init__(self, source=f"{ASSETS_DIR}/provinces.geojson", tolerance=0, quantization=1e5):
+        self.source = source
+        self.tolerance = tolerance
+        self.quantization = quantization
+        suffix = f".lod{tolerance:g}" if tolerance else ''
+        self.path = f"{os.path.splitext(source)[0]}{suffix}.topojson.gz"
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.gzipped = self.raw = self.etag = None
+        self.topology = self.boxes = None
+        self.clips = OrderedDict()  # bounds -> gzipped payload
+
+    def load(self):
+        """Loads the payload, building it first if it's missing or older than the source"""
+        with self.lock:
+            mtime = os.path.getmtime(self.source)
+            if mtime != self.mtime:
+                if not os.path.exists(self.path) or os.path.getmtime(self.path) < mtime:
+                    self.build()
+                with open(self.path, 'rb') as f:
+                    self.gzipped = f.read()
+                self.raw = self.topology = self.boxes = None
+                self.clips.clear()
+                self.etag = hashlib.sha256(self.gzipped).hexdigest()[:32]
+                self.mtime = mtime
+        return self
+
+    def build(self):
+        import topojson
+        with open(self.source) as f:
+            collection = json.load(f)
+        for feature in collection['features']:  # provinces split in many polygons share the id
+            feature['properties']['id'] = feature.pop('id', None)
+        topology = topojson.Topology(collection, prequantize=self.quantization, ignore_index=True,
+                                     toposimplify=self.tolerance)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(gzip.compress(topology.to_json().encode(), 9))
+        os.replace(tmp, self.path)
+
+    def body(self, gzipped=True):
+        if gzipped:
+            return self.gzipped
+        if self.raw is None:  # only for the clients that don't accept gzip
+            self.raw = gzip.decompress(self.gzipped)
+        return self.raw
+
+    def index(self):
+        """Parses the topology and computes the (west, south, east, north) box of every geometry"""
+        topology = json.loads(self.body(gzipped=False))
+        transform = topology.get('transform', {'scale': (1, 1), 'translate': (0, 0)})
+        scale, translate = np.array(transform['scale']), np.array(transform['translate'])
+        arc_boxes = []
+        for arc in topology['arcs']:
+            points = np.array(arc, dtype=np.float64)
+            if 'transform' in topology:  # quantized arcs are delta-encoded
+                points = np.cumsum(points, axis=0)
+            points = points * scale + translate
+            arc_boxes.append((*points.min(axis=0), *points.max(axis=0)))
+        arc_boxes = np.array(arc_boxes).reshape(-1, 4)
+        geometries = next(iter(topology['objects'].values()))['geometries']
+        boxes = np.full((len(geometries), 4), np.nan)  # nan for the geometries that were simplified away
+        for i, geometry in enumerate(geometries):
+            arcs = np.array(arc_indexes(geometry.get('arcs', [])), dtype=np.int64)
+            if len(arcs):
+                b = arc_boxes[np.where(arcs < 0, ~arcs, arcs)]
+                boxes[i] = (*b[:, :2].min(axis=0), *b[:, 2:].max(axis=0))
+        self.topology, self.boxes = topology, boxes
+
+    def clipped(self, bounds):
+        """Returns the gzipped payload of the provinces that intersect bounds (west, south, east, north), with only the
+        arcs they use, and its etag. Bounds are extended to multiples of GRID first."""
+        west, south = (int(b // GRID * GRID) for b in bounds[:2])
+        east, north = (int(-(-b // GRID) * GRID) for b in bounds[2:])
+        key = (west, south, east, north)
+        with self.lock:
+            if key in self.clips:
+                self.clips.move_to_end(key)
+                return self.clips[key], f"{self.etag}-{west}-{south}-{east}-{north}"
+            if self.topology is None:
+                self.index()
+            b = self.boxes
+            # comparisons with nan are false, so geometries that were simplified away are never selected
+            selected = np.flatnonzero((b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south))
+            objects_key, collection = next(iter(self.topology['objects'].items()))
+            geometries = [collection['geometries'][i] for i in selected]
+            used = sorted({~a if a < 0 else a for g in geometries for a in arc_indexes(g['arcs'])})
+            remap = {a: i for i, a in enumerate(used)}
+            topology = {k: v for k, v in self.topology.items() if k not in ('arcs', 'objects', 'bbox')}
+            topology['arcs'] = [self.topology['arcs'][a] for a in used]
+            topology['objects'] = {objects_key: {**collection, 'geometries': [
+                {**g, 'arcs': remap_arcs(g['arcs'], remap)} for g in geometries]}}
+            payload = gzip.compress(json.dumps(topology, separators=(',', ':')).encode(), 6)
+            self.clips[key] = payload
+            while len(self.clips) > self.max_clipped:
+                self.clips.popitem(last=False)
+            return payload, f"{self.etag}-{west}-{south}-{east}-{north}"
+
+
+def arc_indexes(arcs):
+    """Flattens the nested arc indexes of a geometry"""
+    if isinstance(arcs, int):
+        return [arcs]
+    return [a for inner in arcs for a in arc_indexes(inner)]
+
+
+def remap_arcs(arcs, remap):
+    if isinstance(arcs, int):
+        return remap[arcs] if arcs >= 0 else ~remap[~arcs]
+    return [remap_arcs(inner, remap) for inner in arcs]
+
+
+def level(zoom):
+    """Returns the index in LEVELS of the level of detail of zoom"""
+    return max([i for i, (first, _) in enumerate(LEVELS) if first <= zoom], default=0)
+
+
+levels = [GeometryPayload(tolerance=tolerance) for _, tolerance in LEVELS]
+provinces = levels[-1]  # full detail
@@ -0,0 +1,141 @@
+import hashlib
+import logging
+from zipfile import ZipFile
+
+import numpy as np
+
+from parser import Parser, ClausewitzObjectContainer, SKIPPED, Types, U16, read_scalar, scan_object, types
+from util import timing
+
+logger = logging.getLogger(__name__)
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class IncrementalParser:
+    """Parses consecutive saves of the same campaign (e.g. autosaves) reusing the result of the previous one. The
+    gamestate is scanned once by scan_object, which finds the top-level items and the items of the big sections
+    (countries, provinces) without decoding anything. Their byte ranges are hashed and only the items whose bytes
+    changed since the previous save are decoded, the others are taken from the previous result, so the decoding cost
+    of a save becomes proportional to its changes. Unchanged objects are shared between consecutive results, so they
+    must not be modified."""
+
+    def __init__(self):
+        self.parser = Parser(stream=None, whitelist=True, mode='buffer')
+        self.sections = set(Parser.important_keys.values())
+        self.index = {}  # key -> [(length, digest)] of its items in the previous save
+        self.objects = {}  # key -> value in the previous result (SKIPPED if dropped), (index, objects) for the sections
+        self.decoded_bytes = self.total_bytes = 0
+
+    @timing
+    def parse(self, filename):
+        """Returns the content of the save like Parser.from_zip"""
+        with ZipFile(filename) as zf:
+            meta, gamestate = zf.read('meta'), zf.read('gamestate')
+        parser = Parser(stream=None, whitelist=False, mode='buffer')
+        meta = parser.decode(memoryview(meta), offset=6)
+        assert gamestate[:6] == b'EU4bin'
+        self.decoded_bytes, self.total_bytes = 0, len(gamestate)
+        view = memoryview(gamestate)
+        end, _, tokens = scan_object(view, 6, levels=2)
+        if tokens is None:  # empty gamestate
+            tokens = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.int64)
+        self.index, self.objects = self.parse_object(view, end, tokens, self.index, self.objects, top_level=True)
+        logger.debug(f"decoded {self.decoded_bytes / 2 ** 20:.2f}MB out of {self.total_bytes / 2 ** 20:.2f}MB")
+        return {"meta": meta, "gamestate": self.build(self.index, self.objects, top_level=True)}
+
+    def parse_object(self, view, end, tokens, previous_index, previous_objects, top_level=False):
+        """Returns the index and the objects of the items of the object whose content ends at end, given the structural
+        tokens of its top level (as returned by scan_object). Only the items that changed are decoded. At the top level
+        the sections are parsed item by item. Keys dropped by the whitelist are indexed without decoding them."""
+        items, sections, dropped = self.find_items(view, end, tokens, previous_objects if top_level else None)
+        index, objects = {}, {}
+        for key, ranges in items.items():
+            index[key] = [(stop - start, h) for start, stop, h in ranges]
+            if key in sections:
+                objects[key] = sections[key]
+            elif previous_index.get(key) == index[key]:
+                objects[key] = previous_objects[key]
+            elif key in dropped:
+                objects[key] = SKIPPED
+            else:
+                objects[key] = self.decode(view, key, ranges)
+        return index, objects
+
+    def find_items(self, view, end, tokens, previous_sections=None):
+        """Returns key -> [(start, end, digest)] of the items of an object given the structural tokens of its top level,
+        the sections that changed parsed with parse_object, if previous_sections is given, and the keys dropped by the
+        whitelist. Unnamed elements are keyed by (None, position). An item goes from its first token to the first token
+        of the next one, or to end for the last."""
+        offsets, codes, depths = tokens
+        top = np.flatnonzero(depths == 0)
+        top_codes = codes[top]
+        assigns = top_codes == 1
+        named = np.append(assigns[1:], False)  # keys of 'key = value' items
+        values = np.insert(assigns[:-1], 0, False)
+        firsts = np.flatnonzero(~assigns & ~values & (top_codes != 4))  # closing braces end the value before them
+        starts = offsets[top[firsts]].tolist()
+        whitelist = self.parser.whitelist
+        items, sections, dropped = {}, {}, set()
+        for n, (i, start, stop) in enumerate(zip(firsts.tolist(), starts, starts[1:] + [end])):
+            if named[i]:
+                name, is_key = self.name(view, start)
+                if whitelist and is_key and name not in whitelist:  # same rule of Parser.decode
+                    dropped.add(name)
+                elif previous_sections is not None and name in self.sections and i + 3 < len(top) and \
+                        top_codes[i + 2] == 3:
+                    first, last = top[i + 2] + 1, top[i + 3]  # tokens between the braces of the section
+                    content = offsets[first:last], codes[first:last], depths[first:last] - 1
+                    sections[name] = self.parse_object(view, int(offsets[last]), content,
+                                                       *previous_sections.get(name, ({}, {})))
+            else:
+                name = None, n
+            items.setdefault(name, []).append((start, stop, digest(view[start:stop])))
+        return items, sections, dropped
+
+    def name(self, view, offset):
+        """Returns the key at offset as Parser.decode names it and whether it's a key token, the only ones the whitelist
+        applies to, rather than a string or a number"""
+        code = U16.unpack_from(view, offset)[0]
+        if types.get(code, Types.KEY) is not Types.KEY:
+            return read_scalar(view, offset, Parser.keys), False
+        return Parser.keys.get(code) or Parser.important_keys.get(code) or self.parser.unknown_key(code), True
+
+    def build(self, index, objects, top_level=False):
+        """Returns the container of the decoded objects, leaving out those dropped by the whitelist"""
+        container = ClausewitzObjectContainer()
+        for key, value in objects.items():
+            if top_level and key in self.sections:
+                value = self.build(*value) or None
+            if value is None or value is SKIPPED:
+                continue
+            if isinstance(key, tuple):
+                container.add(value)
+            elif not isinstance(value, list):
+                container[key] = value
+            elif objects.get(f"{key}s", SKIPPED) is not SKIPPED:  # the name of the group is taken, the last value wins
+                container[key] = value[-1]
+            else:
+                group = container[f"{key}s"] = ClausewitzObjectContainer()
+                for v in value:
+                    group.add(v)
+        return container
+
+    def decode(self, view, key, ranges):
+        """Decodes the items of key found in ranges. Returns None if they're all empty, the list of values that
+        ClausewitzObjectContainer would group if the key is a string found again after its first non-empty value,
+        otherwise the last value. Groups are built by build, which knows the other keys of the object."""
+        values, first = [], None
+        for n, (start, end, _) in enumerate(ranges):
+            self.decoded_bytes += end - start
+            decoded = self.parser.decode(view, start, end).values()
+            if decoded and first is None:
+                first = n
+            values.extend(decoded)
+        if not values:
+            return None
+        if isinstance(key, str) and first < len(ranges) - 1:
+            return values
+        return values[-1]
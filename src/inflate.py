@@ -0,0 +1,115 @@
+import io
+import mmap
+import queue
+import struct
+import threading
+from zipfile import ZIP_STORED
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')  # local file header of a zip entry, see zipfile.structFileHeader
+
+
+class InflateStream(io.RawIOBase):
+    """Decompresses a zip entry in a background thread into a ring of fixed-size buffers that are handed to the reader
+    in order, so that inflation overlaps with parsing. When the reader falls behind the thread waits for a buffer to be
+    given back, so memory is bounded by buffers * buffer_size whatever the size of the entry."""
+
+    def __init__(self, source, buffer_size=1 << 20, buffers=4):
+        self.source = source
+        self.ring = [bytearray(buffer_size) for _ in range(buffers)]
+        self.free, self.filled = queue.Queue(), queue.Queue()
+        for i in range(buffers):
+            self.free.put(i)
+        self.slot = None  # buffer being read
+        self.current = memoryview(b'')  # unread part of it
+        self.eof = False
+        self.thread = threading.Thread(target=self.inflate, daemon=True)
+        self.thread.start()
+
+    def inflate(self):
+        try:
+            while True:
+                i = self.free.get()
+                if i is None:  # closed by the reader
+                    return
+                n = self.source.readinto(self.ring[i])
+                self.filled.put((i, n))
+                if not n:
+                    return
+        except Exception as e:  # raised again in the reader
+            self.filled.put((None, e))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.current):
+            if self.eof:
+                return 0
+            if self.slot is not None:
+                self.free.put(self.slot)
+            self.slot, n = self.filled.get()
+            if self.slot is None:
+                raise n
+            if not n:
+                self.eof = True
+                return 0
+            self.current = memoryview(self.ring[self.slot])[:n]
+        n = min(len(b), len(self.current))
+        b[:n] = self.current[:n]
+        self.current = self.current[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.free.put(None)
+            while self.thread.is_alive():  # gives the buffers back in case the thread is waiting for one
+                try:
+                    self.free.put(self.filled.get(timeout=0.1)[0])
+                except queue.Empty:
+                    pass
+            self.thread.join()
+            self.current.release()
+            self.source.close()
+        super().close()
+
+
+class Prefixed(io.RawIOBase):
+    """Stream that returns prefix before the rest of stream, used to give back bytes read past the end of a section"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = memoryview(prefix)
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.prefix):
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def map_entry(filename, info):
+    """Maps the content of a stored (uncompressed) entry of the zip in memory, positioned at its first byte"""
+    with open(filename, 'rb') as f:
+        f.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+        start = info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1]  # name and extra field lengths
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        mm = mmap.mmap(f.fileno(), start + info.file_size - offset, access=mmap.ACCESS_READ, offset=offset)
+    mm.seek(start - offset)
+    return mm
+
+
+def open_entry(zf, name, buffer_size=1 << 20, buffers=4):
+    """Opens an entry of the zip for reading: stored entries are mapped in memory, compressed ones are inflated in a
+    background thread through an InflateStream"""
+    info = zf.getinfo(name)
+    if info.compress_type == ZIP_STORED:
+        return map_entry(zf.filename, info)
+    return io.BufferedReader(InflateStream(zf.open(info), buffer_size, buffers), buffer_size)
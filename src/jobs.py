@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import metrics
+from src import ASSETS_DIR
+
+JOBS_DIR = f"{ASSETS_DIR}/jobs"
+JOB_ID = re.compile(r'[0-9a-f]{32}')
+MAX_UPLOAD_SIZE = int(os.getenv('JOB_MAX_UPLOAD_MB', 128)) << 20
+
+
+class QueueFull(Exception):
+    pass
+
+
+def write_json(path, d):
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(d, f, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o))
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def update_status(directory, state, **kwargs):
+    status = read_json(os.path.join(directory, 'status.json')) or {'id': os.path.basename(directory),
+                                                                   'created': time.time()}
+    status.update(state=state, updated=time.time(), **kwargs)
+    write_json(os.path.join(directory, 'status.json'), status)
+    return status
+
+
+def process_save(directory):
+    """Worker task: parses the save of a job, exports its columns and the colors of its tile layers and draws the heat
+    map of the player in the directory of the job, keeping its status up to date"""
+    update_status(directory, 'running', started=time.time())
+    try:
+        from analyzer import Analyzer
+        from cache import SaveCache
+        from export import Columns
+        from models import Campaign
+        from tiles import campaign_layers
+        campaign = Campaign.from_save(os.path.join(directory, 'save.eu4'), player_only=True, cache=SaveCache())
+        Columns.from_gamestate(campaign.gameinfo['gamestate']).save(os.path.join(directory, 'columns'))
+        analyzer = Analyzer()
+        analyzer.campaign = campaign
+        analyzer.draw_conquest_heat_map(output=os.path.join(directory, 'heatmap.png'))
+        layers = campaign_layers(campaign, analyzer)
+        write_json(os.path.join(directory, 'layers.json'), layers)
+        player = campaign.get_country()
+        write_json(os.path.join(directory, 'result.json'), {
+            'player': campaign.player, 'date': campaign.current_date.isoformat(),
+            'provinces': len(player.owned_provinces), 'avg_ruler_stats': player.avg_ruler_stats,
+            'avg_ruler_life': player.avg_ruler_life, 'heatmap': 'heatmap.png', 'layers': list(layers)})
+        update_status(directory, 'done', finished=time.time())
+    except Exception:
+        update_status(directory, 'failed', finished=time.time(), error=traceback.format_exc(limit=3))
+
+
+class JobQueue:
+    """Saves uploaded to the server, processed by process_save in a pool of at most workers processes. Jobs are
+    identified by the hash of the save, so uploading a save again returns the job of the first upload, unless it
+    failed or it's stale (queued or running for more than stale_after seconds, e.g. because the server restarted).
+    Everything about a job is in its directory, so any web worker can report the jobs of the others. Uploads are
+    refused with QueueFull when max_pending jobs of this process are waiting or running."""
+    chunk_size = 1 << 20
+
+    def __init__(self, directory=JOBS_DIR, workers=2, max_pending=16, stale_after=3600):
+        self.directory = directory
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        self.pending = {}  # job id -> future
+        self.lock = threading.Lock()
+        self.executor = None  # created on the first job, so that every forked web worker gets its own
+
+    def job_directory(self, job_id):
+        if not JOB_ID.fullmatch(job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.directory, job_id)
+
+    def status(self, job_id):
+        """Returns the status of a job, raising KeyError if it doesn't exist"""
+        status = read_json(os.path.join(self.job_directory(job_id), 'status.json'))
+        if status is None:
+            raise KeyError(job_id)
+        return status
+
+    def path(self, job_id, name):
+        """Returns the path of the file name of a finished job, raising KeyError if there's none"""
+        path = os.path.join(self.job_directory(job_id), name)
+        if not os.path.isfile(path) or self.status(job_id)['state'] != 'done':
+            raise KeyError(name)
+        return path
+
+    def submit(self, stream):
+        """Stores the save read from the file object stream and queues its job. Returns the status of the job and
+        whether it was created by this upload."""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, f".upload.{uuid.uuid4().hex}")
+        h = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+            job_id = h.hexdigest()[:32]
+            directory = self.job_directory(job_id)
+            with self.lock:
+                try:
+                    status = self.status(job_id)
+                except KeyError:
+                    status = None
+                if status is not None and not self.retry(status):
+                    metrics.count('jobs_deduplicated')
+                    return status, False
+                if len(self.pending) >= self.max_pending:
+                    raise QueueFull(f"{len(self.pending)} jobs are already pending")
+                os.makedirs(directory, exist_ok=True)
+                os.replace(tmp, os.path.join(directory, 'save.eu4'))
+                status = update_status(directory, 'queued', created=time.time(), error=None)
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(self.workers)
+                self.pending[job_id] = future = self.executor.submit(process_save, directory)
+            future.add_done_callback(lambda _: self.done(job_id))
+            metrics.count('jobs_submitted')
+            return status, True
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def retry(self, status):
+        """Whether the job of status has to be submitted again"""
+        if status['state'] == 'failed':
+            return True
+        stale = status['state'] in ('queued', 'running') and time.time() - status['updated'] > self.stale_after
+        return stale and status['id'] not in self.pending
+
+    def done(self, job_id):
+        with self.lock:
+            self.pending.pop(job_id, None)
+
+
+queue = JobQueue(workers=int(os.getenv('JOB_WORKERS', 2)), max_pending=int(os.getenv('JOB_MAX_PENDING', 16)))
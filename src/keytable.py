@@ -0,0 +1,85 @@
+import mmap
+import os
+
+import numpy as np
+
+MAGIC = b'EU4KEYS1'
+CODES = 1 << 16
+
+
+def build(source, destination):
+    """Compiles the 'code name' lines of source in a dense binary table: after the magic come the CODES + 1 uint32
+    offsets of the names, indexed by token code, and then the names. Codes without a name have an empty one."""
+    names = [b''] * CODES
+    with open(source, 'rb') as f:
+        for line in f:
+            if line.strip():
+                k, v = line.split()
+                names[int(k, 16)] = v
+    offsets = np.zeros(CODES + 1, dtype='<u4')
+    np.cumsum([len(n) for n in names], out=offsets[1:])
+    tmp = f"{destination}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(offsets.tobytes())
+        f.write(b''.join(names))
+    os.replace(tmp, destination)
+
+
+class KeyTable(dict):
+    """Names of the token codes read from the table compiled by build, which is mapped in memory instead of being
+    parsed. Names are decoded the first time they're looked up and then stay in the dict, so lookups in the hot loops
+    are plain dict lookups. Looking up a name returns its code. Codes in exclude are treated as missing, the parser
+    uses it to handle the important keys by itself."""
+
+    def __init__(self, path, exclude=()):
+        super().__init__()
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a key table")
+        self.offsets = np.frombuffer(self.mm, dtype='<u4', count=CODES + 1, offset=len(MAGIC))
+        self.base = len(MAGIC) + self.offsets.nbytes
+        self.exclude = set(exclude)
+        self.codes = None  # name -> code, built on the first lookup by name
+
+    @classmethod
+    def load(cls, source, exclude=()):
+        """Loads the table compiled from source, compiling it first if it's missing or older than source"""
+        path = f"{os.path.splitext(source)[0]}.bin"
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+            build(source, path)
+        return cls(path, exclude)
+
+    def __missing__(self, key):
+        if isinstance(key, str):
+            if self.codes is None:
+                self.codes = {self.name(int(c)): int(c) for c in np.flatnonzero(np.diff(self.offsets))}
+            value = self.codes[key]
+        elif key in self.exclude or not 0 <= key < CODES or self.offsets[key] == self.offsets[key + 1]:
+            raise KeyError(key)
+        else:
+            value = self.name(key)
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, TypeError):
+            return default
+
+    def name(self, code):
+        start, end = int(self.offsets[code]), int(self.offsets[code + 1])
+        return self.mm[self.base + start:self.base + end].decode()
+
+    def __repr__(self):
+        return f"KeyTable({len(self)} loaded)"
+
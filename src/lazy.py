@@ -0,0 +1,171 @@
+from collections.abc import Mapping
+from zipfile import ZipFile
+
+import numpy as np
+
+from parser import Parser, Types, ClausewitzObjectContainer, read_scalar, scan_object, types
+from text import transcode
+
+
+class LazySave(Mapping):
+    """Read-only view over a save file that decodes objects only when they're accessed. Every entry of the zip (meta,
+    gamestate) is a LazyObject: objects nested less than lazy_depth levels are returned as LazyObject, deeper ones are
+    decoded into a ClausewitzObjectContainer and cached. With the default depth save["gamestate"]["countries"]["SWE"]
+    decodes only the content of Sweden. The structural tokens of the entries, as returned by structure, can be given
+    to skip scanning them again."""
+    entries = ('meta', 'gamestate')
+
+    def __init__(self, filename, lazy_depth=2, buffers=None, tokens=None):
+        self.filename = filename
+        self.lazy_depth = lazy_depth
+        if buffers is None:
+            with ZipFile(filename) as zf:
+                buffers = {name: zf.read(name) for name in self.entries}
+        self.buffers = buffers
+        self.tokens = tokens or {}  # name -> (offsets, codes, depths) of the top level of the entry
+        self.objects = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.objects[name]
+        except KeyError:
+            # same whitelist rules used by Parser.from_zip
+            parser = Parser(stream=None, whitelist=name == 'gamestate', mode='buffer')
+            view = self.view(name)
+            obj = self.objects[name] = LazyObject(view, parser, 6, len(view), self.tokens.get(name),
+                                                  lazy_depth=self.lazy_depth)
+            return obj
+
+    def structure(self, name):
+        """Returns the structural tokens of the entry name, scanning it if it wasn't yet, or None if it's empty"""
+        obj = self[name]
+        if obj.index is None:
+            obj.build_index()
+        return obj.tokens
+
+    def view(self, name):
+        buffer = self.buffers[name]
+        if buffer[:6] == b'EU4txt':  # plaintext saves are read through their binary tokens
+            Parser(stream=None)
+            buffer = self.buffers[name] = b'EU4bin' + transcode(buffer[6:], Parser.keys)
+        assert buffer[:6] == b'EU4bin'
+        return memoryview(buffer)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"LazySave({self.filename})"
+
+
+class LazyObject(Mapping):
+    """An object of the save, whose content goes from start to the offset of its closing brace end (the end of the
+    content for the top level). Keys are indexed on first access from the structural tokens of the object: the top
+    level scans its content with scan_object keeping only the tokens nested less than lazy_depth levels, and every
+    LazyObject inside it gets its slice of them, so nothing is scanned twice and nothing deeper is ever indexed.
+    Repeated keys are grouped in a '<key>s' container as done by ClausewitzObjectContainer and empty objects are
+    dropped, but objects that only hold empty objects are kept, since their content isn't indexed."""
+
+    def __init__(self, view, parser, start, end, tokens=None, depth=0, lazy_depth=2):
+        self.view = view
+        self.parser = parser
+        self.start = start
+        self.end = end
+        self.tokens = tokens  # (offsets, codes, depths) of the tokens nested less than lazy_depth - depth levels
+        self.depth = depth
+        self.lazy_depth = lazy_depth
+        self.index = None  # key -> (token of the value, token of its closing brace or None for scalars), or a list
+        self.cache = {}
+        self.decoded = None
+
+    def build_index(self):
+        if self.tokens is None:
+            _, _, self.tokens = scan_object(self.view[:self.end], self.start, levels=self.lazy_depth - self.depth)
+        whitelist, keys = self.parser.whitelist, Parser.all_keys
+        items, count = {}, 0  # key -> values in the order they were found, list elements use their position
+        if self.tokens is not None:
+            offsets, codes, depths = self.tokens
+            top = np.flatnonzero(depths == 0)
+            tokens, top_codes = top.tolist(), codes[top].tolist()
+            k = 0
+            while k < len(tokens):
+                key = None
+                if k + 1 < len(tokens) and top_codes[k + 1] == 1:  # key = value
+                    key, code = read_scalar(self.view, int(offsets[tokens[k]]), keys), top_codes[k]
+                    k += 2
+                    if whitelist and types.get(code, Types.KEY) is Types.KEY and key not in whitelist:
+                        key = False
+                if top_codes[k] == 3:
+                    value = (tokens[k], tokens[k + 1])
+                    if offsets[tokens[k + 1]] - offsets[tokens[k]] == 2:  # empty objects are dropped
+                        value = None
+                    k += 2
+                else:
+                    value = (tokens[k], None)
+                    k += 1
+                if key is None:
+                    if value is not None:
+                        items[count] = [value]
+                        count += 1
+                elif key is not False:
+                    items.setdefault(key, []).append(value)
+        self.index = {}
+        for key, values in items.items():
+            # like ClausewitzObjectContainer: a key is grouped when it's found again after its first non-empty value,
+            # unless it isn't a string or the object has a key with the name of the group, then its last value wins
+            first = next((n for n, v in enumerate(values) if v is not None), None)
+            if first is None:
+                continue
+            if isinstance(key, str) and first < len(values) - 1 and f"{key}s" not in items:
+                self.index[f"{key}s"] = [v for v in values if v is not None]
+            else:
+                self.index[key] = next(v for v in reversed(values) if v is not None)
+
+    def __getitem__(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            if self.index is None:
+                self.build_index()
+            v = self.index[key]
+            if isinstance(v, list):
+                value = ClausewitzObjectContainer()
+                for item in v:
+                    value.add(self.load(item))
+            else:
+                value = self.load(v)
+            self.cache[key] = value
+            return value
+
+    def __iter__(self):
+        if self.index is None:
+            self.build_index()
+        return iter(self.index)
+
+    def __len__(self):
+        if self.index is None:
+            self.build_index()
+        return len(self.index)
+
+    def __repr__(self):
+        return f"LazyObject(depth={self.depth}, keys={len(self)})"
+
+    def load(self, value):
+        i, j = value
+        offsets = self.tokens[0]
+        if j is None:
+            return read_scalar(self.view, int(offsets[i]), Parser.all_keys)
+        start, end = int(offsets[i]) + 2, int(offsets[j])
+        if self.depth + 1 < self.lazy_depth:
+            tokens = tuple(a[i + 1:j] for a in self.tokens[:2]) + (self.tokens[2][i + 1:j] - 1,)
+            return LazyObject(self.view, self.parser, start, end, tokens, self.depth + 1, self.lazy_depth)
+        return self.parser.decode(self.view, start, end)
+
+    def decode(self):
+        """Decodes the whole object into a ClausewitzObjectContainer"""
+        if self.decoded is None:
+            self.decoded = self.parser.decode(self.view, self.start, self.end)
+        return self.decoded
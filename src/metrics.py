@@ -0,0 +1,127 @@
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'eu4tracker-metrics'))
+PROFILE_ENV = 'EU4_PROFILE'  # profiles every request when set to 1
+PROFILE_HEADER = 'X-Profile'  # profiles a single request when set to 1, in debug or with PROFILE_REQUESTS set
+
+
+class Metrics:
+    """Per-process registry of timing spans and counters. Spans are nested: a span opened inside another is recorded
+    under the path of both, e.g. 'from_zip/parse_buffer', with its count, total and max time. Every process dumps its
+    numbers to a file of METRICS_DIR named after its pid, so that any worker can report the numbers of all of them."""
+    flush_interval = 5  # seconds between two dumps
+
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.spans = defaultdict(lambda: [0, 0.0, 0.0])  # path -> [count, total, max]
+        self.counters = defaultdict(int)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.last_flush = 0
+
+    @contextmanager
+    def span(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        path = '/'.join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                s = self.spans[path]
+                s[0] += 1
+                s[1] += elapsed
+                s[2] = max(s[2], elapsed)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            spans = {k: {'count': c, 'total': t, 'max': m} for k, (c, t, m) in self.spans.items()}
+        return {'pid': self.pid, 'uptime': time.time() - self.started, 'spans': spans, 'counters': dict(self.counters)}
+
+    def flush(self, force=False):
+        """Writes the snapshot of this process, at most once every flush_interval seconds unless forced"""
+        now = time.time()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = now
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.pid}.json")
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self):
+        """Returns the snapshots of all the live processes and their totals"""
+        self.flush(force=True)
+        workers = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            pid = int(os.path.basename(path).split('.')[0])
+            try:
+                os.kill(pid, 0)
+                with open(path) as f:
+                    workers[pid] = json.load(f)
+            except (OSError, ValueError):  # dead process or file being replaced
+                continue
+        total = {'spans': {}, 'counters': defaultdict(int)}
+        for snapshot in workers.values():
+            for k, s in snapshot['spans'].items():
+                t = total['spans'].setdefault(k, {'count': 0, 'total': 0.0, 'max': 0.0})
+                t['count'] += s['count']
+                t['total'] += s['total']
+                t['max'] = max(t['max'], s['max'])
+            for k, v in snapshot['counters'].items():
+                total['counters'][k] += v
+        return {'workers': workers, 'total': total}
+
+
+metrics = Metrics()
+os.register_at_fork(after_in_child=lambda: metrics.__init__(metrics.directory))  # workers start from scratch
+
+
+def profiling_enabled(headers=None):
+    return os.getenv(PROFILE_ENV) == '1' or (headers is not None and headers.get(PROFILE_HEADER) == '1')
+
+
+class Profile:
+    """cProfile capture of a block of code, saved in METRICS_DIR/profiles so that it can be opened with pstats or
+    snakeviz. summary() returns the functions that took the most cumulative time."""
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.path = None
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        directory = os.path.join(METRICS_DIR, 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        name = ''.join(c if c.isalnum() else '_' for c in self.name)
+        self.path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}.prof")
+        self.profile.dump_stats(self.path)
+
+    def summary(self, n=20):
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(n)
+        return out.getvalue()
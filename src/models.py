@@ -1,10 +1,12 @@
 import itertools
 import json
+from collections.abc import Sequence
 from datetime import datetime
 
 import numpy as np
 from colour import Color
 
+from lazy import LazySave
 from util import yield_info, get_date, calculate_months_diff, timing
 
 START_DATE = datetime(year=1444, month=11, day=11)
@@ -33,12 +35,13 @@ class Campaign:
         self.player = gameinfo["meta"]["player"]
         self.current_date = get_date(gameinfo["meta"]["date"])
         self.countries = {}
-        for tag, c in gameinfo["gamestate"]["countries"].items():
+        countries = gameinfo["gamestate"]["countries"]
+        for tag in (self.player,) if player_only else countries:
             try:
-                self.countries[tag] = Country(tag=tag, **c)
+                self.countries[tag] = Country(tag=tag, **countries[tag])
             except DummyCountryException:  # fixme some real countries don't have revolutionary colors, find another key
                 pass
-        self.provinces = [Province(id=int(i[1:]), **p) for i, p in gameinfo["gamestate"]["provinces"].items()]
+        self.provinces = ProvinceList(gameinfo["gamestate"]["provinces"])
         if player_only:
             player_country = self.countries[self.player]
             player_country.analyze(self)
@@ -59,6 +62,14 @@ class Campaign:
             d = json.load(f)
             return cls(gameinfo=d, player_only=player_only)
 
+    @classmethod
+    @timing
+    def from_save(cls, filename, player_only=False, cache=None):
+        """Loads the campaign from a .eu4 file through a LazySave, only decoding the countries and provinces used. When
+        a SaveCache is given, saves that were already parsed are loaded from it."""
+        save = cache.load(filename) if cache is not None else LazySave(filename)
+        return cls(gameinfo=save, player_only=player_only)
+
 
 class Country:
     # https://eu4.paradoxwikis.com/Template:Revolutionary_flag
@@ -89,10 +100,10 @@ class Country:
 
     def calculate_provinces(self, provinces):
         for k in ('owned_provinces', 'controlled_provinces', 'core_provinces'):
-            setattr(self, k, list(sorted((provinces[i - 1] for i in getattr(self, k).values()),
+            setattr(self, k, list(sorted((provinces.by_id(i) for i in getattr(self, k).values()),
                                          key=lambda p: p.last_conquest)))
         for k in ('capital', 'trade_port'):
-            setattr(self, k, provinces[getattr(self, k)])
+            setattr(self, k, provinces.by_id(getattr(self, k)))
         # fixme add subject provinces
 
     def get_ruler_history(self, current_date):
@@ -138,18 +149,53 @@ class Country:
         return spectrum[:-(len(spectrum) - n + 1)] + [spectrum[-1]]
 
 
+class ProvinceList(Sequence):
+    """Provinces of the campaign in the order they appear in the save. Province objects are built the first time
+    they're accessed, so that analyzing a single country only decodes the provinces it refers to."""
+
+    def __init__(self, provinces):
+        self.provinces = provinces
+        self.ids = list(provinces)
+        self.cache = {}
+        self.positions = None  # province id -> position, built on the first lookup by id
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        i = range(len(self))[i]
+        try:
+            return self.cache[i]
+        except KeyError:
+            key = self.ids[i]
+            province = self.cache[i] = Province(id=abs(int(key)), **self.provinces[key])  # keys are negative ids
+            return province
+
+    def __len__(self):
+        return len(self.ids)
+
+    def by_id(self, province_id):
+        if self.positions is None:
+            self.positions = {abs(int(key)): i for i, key in enumerate(self.ids)}
+        return self[self.positions[province_id]]
+
+
 class Province:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
-        self.last_conquest = datetime(year=1444, month=11, day=11)
+        self.last_conquest = self.get_last_conquest(kwargs.get('history'))
+
+    @staticmethod
+    def get_last_conquest(history):
+        last_conquest = START_DATE
         try:
-            for k, v in yield_info(((k, v) for k, v in self.history.items() if k[0].isnumeric())):
-                inner, tag = v.popitem()
+            for k, v in yield_info(((k, v) for k, v in history.items() if k[0].isnumeric())):
+                inner = list(v.keys())[-1]
                 # fixme this probably breaks with tag-switching countries, see occupations as well
                 if inner == 'owner':
-                    self.last_conquest = get_date(k)
+                    last_conquest = get_date(k)
         except AttributeError:  # no history -> uncolonized?
             pass
+        return last_conquest
 
     def __str__(self):
         return f"{self.name}"
@@ -1,20 +1,31 @@
+import atexit
 import calendar
 import csv
 import io
 import json
+import logging
+import marshal
+import mmap
 import os
 import re
 import struct
-import uuid
 from enum import Enum
-from multiprocessing import Process
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from multiprocessing import Pool, shared_memory
 from zipfile import ZipFile
 
 import numpy as np
 
+from inflate import Prefixed, open_entry
+from keytable import KeyTable
+from metrics import metrics
 from src import ASSETS_DIR
+from text import transcode
 from util import timing
 
+logger = logging.getLogger(__name__)
+
 
 # https://codeofwar.wbudziszewski.pl/2015/07/29/binary-savegames-insight/
 
@@ -45,24 +56,70 @@ types = {
     400: Types.FLOAT5
 }
 
+# precompiled readers used by the buffer engine, they unpack directly from the memoryview at a given offset
+U16 = struct.Struct('<H')
+I16 = struct.Struct('<h')
+I32 = struct.Struct('<i')
+I64 = struct.Struct('<q')
+PAYLOAD_SIZES = {12: 4, 13: 4, 14: 1, 20: 4, 359: 8, 400: 8}  # strings carry their own length
+KINDS = np.full(1 << 16, Types.KEY.value, dtype=np.uint8)  # token code -> Types value, used to classify a whole tape
+for code, t in types.items():
+    KINDS[code] = t.value
+STEPS = np.full(1 << 16, 2, dtype=np.int32)  # token code -> bytes up to the next token, strings add their length
+for code, size in PAYLOAD_SIZES.items():
+    STEPS[code] += size
+STEPS[15] = STEPS[23] = 4
+SCAN_TOKENS = 4096  # tokens skipped one by one before switching to scan_object
+SCAN_WINDOW = 4 << 20  # biggest window of bytes scanned at once, bounds the memory of token_offsets
+
+
+@lru_cache(maxsize=None)
+def decode_date(n):
+    """https://gitgud.io/nixx/paperman/-/blob/master/paperman/src/Util/numberToDate.ts"""
+    zero_date = 43800000  # year 0. only 1.1.1 seems to be used in years between 0 and ~1300
+    if n < zero_date or n > 60000000:  # only parses dates between 1.1.1 and ~ 1850
+        if n == 43791240:
+            return '-1.1.1'
+        return n
+    n = (n - zero_date) // 24
+    year, n = divmod(n, 365)
+    month = day = 1
+    for m in range(1, 12):
+        _, month_length = calendar.monthrange(1995, m)
+        if n >= month_length:
+            n -= month_length
+            month += 1
+        else:
+            break
+    day += n
+    return f"{year}.{month}.{day}"
+
 
 class Parser:
-    keys = {}
+    keys = None  # KeyTable of code <-> name, without the important keys
+    all_keys = None  # KeyTable with the important keys too, used to name the tokens of tapes
     important_keys = {11854: "countries", 10291: "provinces"}
     whitelist = set()
-    chunks = 8
-
-    def __init__(self, stream, filename=None, pattern=None, whitelist=True, human_only_countries=False):
+    human_key = 0x2cae  # first key of the countries played by humans
+    workers = os.cpu_count()
+    chunks_per_worker = 4  # more chunks than workers to balance the load, countries have very different sizes
+    pool = None  # persistent worker pool, see get_pool
+    modes = ('stream', 'buffer')
+    window_size = 16 << 20  # bytes of a big section parsed at once in stream mode
+
+    def __init__(self, stream, filename=None, whitelist=True, human_only_countries=False, mode='stream'):
+        if mode not in self.modes:
+            raise ValueError(f"unknown parser mode {mode}, expected one of {self.modes}")
         self.stream = stream
+        self.mode = mode
         self.filename = filename
-        self.pattern = pattern
         self.human_only_countries = human_only_countries
-        self.parsers = []
         self.init()
         self.whitelist = self.whitelist if whitelist else None
         self.curr_code = 0
         self.container = ClausewitzObjectContainer()
         self.last_is_key = False  # boolean used to drop unnecessary keys
+        self.skipped = SkipReport()
         self.funcs = {
             Types.EQ: self.assign,
             Types.LBR: self.open_object,
@@ -76,28 +133,22 @@ class Parser:
             Types.KEY: self.read_key
         }
 
-    def init(self):
-        if self.keys:
+    @classmethod
+    def init(cls):
+        if cls.keys is not None:
             return
-        with open(f"{ASSETS_DIR}/keys.txt") as f:
-            for line in f.readlines():
-                k, v = line.split()
-                k = int(k, 16)
-                v = v.rstrip()
-                self.keys[k] = v
-                self.keys[v] = k
-            for k in self.important_keys:
-                del self.keys[k]
+        cls.keys = KeyTable.load(f"{ASSETS_DIR}/keys.txt", exclude=cls.important_keys)
+        cls.all_keys = KeyTable.load(f"{ASSETS_DIR}/keys.txt")
         with open(f"{ASSETS_DIR}/keys_whitelist.csv") as f:
             r = csv.reader(f)
-            self.whitelist.update({k for k, d in r})
+            cls.whitelist.update({k for k, d in r})
 
     def parse(self, read_header=True):
-        if self.pattern:
-            self.parse_parallel()
+        if read_header:
+            self.check_header()
+        if self.mode == 'buffer':
+            self.parse_buffer(read_header=False)
         else:
-            if read_header:
-                assert self.stream.read(6) == b'EU4bin'
             try:
                 while True:
                     self.read_code()
@@ -107,27 +158,259 @@ class Parser:
                     with open(self.filename, 'w') as f:
                         json.dump(self.container, f)
 
+    def check_header(self):
+        """Reads the header of the stream. Plaintext (EU4txt) content is transcoded to binary tokens, so that it goes
+        through the same parsing code as ironman saves."""
+        header = self.stream.read(6)
+        if header == b'EU4txt':
+            self.stream = io.BytesIO(transcode(self.stream.read(), self.keys))
+        else:
+            assert header == b'EU4bin'
+
     @timing
-    def parse_parallel(self):
-        """Uses multiprocessing to parse a big top-level object faster by splitting the content in chunks and spawning
-        workers"""
-        content = self.stream.read()
-        matches = re.findall(self.pattern, content, flags=re.DOTALL)
-        ls = np.array(matches, dtype=np.object_)
-        for group in np.array_split(ls, min(self.chunks, len(ls))):
-            chunk = b''.join(group)
-            self.parsers.append(Parser(stream=io.BytesIO(chunk), filename=str(uuid.uuid4())))  # fixme use tempfiles
-        processes = []
-        for parser in self.parsers:
-            processes.append(Process(target=parser.parse, args=(False,)))
-            processes[-1].start()
-        for process in processes:
-            process.join()
-        for parser in self.parsers:
-            with open(parser.filename) as f:
-                d = json.load(f)
-                self.container.update(d)
-            os.remove(parser.filename)
+    def parse_buffer(self, read_header=True):
+        """Parses the whole content with a single offset cursor over a memoryview of the decompressed buffer instead of
+        reading every token from the stream. The result is the same container built by the stream mode: big sections
+        are not split since the loop is fast enough to go through them sequentially."""
+        if read_header:
+            self.check_header()
+        stream = self.stream
+        if isinstance(stream, mmap.mmap):  # mapped content is decoded in place without copying it
+            view = memoryview(stream)[stream.tell():]
+        else:
+            view = memoryview(stream.read())
+        self.container = self.decode(view)
+        if self.filename:
+            with open(self.filename, 'w') as f:
+                json.dump(self.container, f)
+
+    def decode(self, view, offset=0, end=None):
+        """Decodes the tokens found in view between offset and end into a new top-level container"""
+        end = (len(view) if end is None else end) - 1
+        u16, i16, i32, i64 = U16.unpack_from, I16.unpack_from, I32.unpack_from, I64.unpack_from
+        keys, important_keys, whitelist = self.keys, self.important_keys, self.whitelist
+        container = ClausewitzObjectContainer()
+        last_is_key = False
+        assign = None  # drop flag of the assignment waiting for its value
+        first, count, objects = offset, 0, 0  # for the metrics
+        while offset < end:
+            code = u16(view, offset)[0]
+            offset += 2
+            count += 1
+            is_key = False
+            if code == 1:
+                assign = bool(whitelist and last_is_key and container.get_last() not in whitelist)
+                last_is_key = False
+                continue
+            elif code == 3:
+                if assign:  # value of a key dropped by the whitelist, skip it without building anything
+                    start = offset
+                    offset, tokens = skip_object(view, offset)
+                    self.skipped.add(container.get_last(), tokens, offset - start + 2)
+                    container.append(SKIPPED)
+                else:
+                    container = ClausewitzObjectContainer(parent=container)
+                    container.parent.append(container)
+                    objects += 1
+            elif code == 4:
+                container = container.close()
+            elif code == 20:
+                container.append(i32(view, offset)[0])
+                offset += 4
+            elif code == 15 or code == 23:
+                length = i16(view, offset)[0]
+                offset += 2
+                container.append(str(view[offset:offset + length], 'windows-1252'))
+                offset += length
+            elif code == 12:
+                container.append(decode_date(i32(view, offset)[0]))
+                offset += 4
+            elif code == 13:
+                container.append(i32(view, offset)[0] / 1000)
+                offset += 4
+            elif code == 14:
+                container.append(view[offset] != 0)
+                offset += 1
+            elif code == 359 or code == 400:
+                container.append(i64(view, offset)[0] / 32768)
+                offset += 8
+            else:
+                try:
+                    k = keys[code]
+                except KeyError:
+                    k = important_keys.get(code) or self.unknown_key(code, container)
+                container.append(k)
+                is_key = True
+            if assign is not None:
+                container.name_last(drop=assign)
+                assign = None
+                is_key = False
+            last_is_key = is_key
+        while container.parent is not None:  # truncated content, close what was left open
+            container = container.close()
+        container.close()
+        metrics.count('bytes_scanned', offset - first)
+        metrics.count('tokens_decoded', count)
+        metrics.count('containers_allocated', objects)
+        return container
+
+    def iter_events(self, *subscriptions, read_header=True, block_size=1 << 20):
+        """Yields (event, path, key, value) tuples straight from the token stream without building any container. event
+        is 'start' or 'end' for objects (value is None) and 'value' for scalars, path is the tuple of keys of the
+        enclosing objects and unnamed elements are keyed by their position. Subscriptions are dotted path patterns like
+        'countries.*.ledger': only events at or below a matching path are yielded and objects that can't lead to one
+        are skipped without decoding them. The stream is read in blocks, so memory doesn't grow with the content."""
+        patterns = [tuple(s.split('.')) for s in subscriptions]
+        if read_header:
+            self.check_header()
+        stream, keys, important_keys = self.stream, self.keys, self.important_keys
+        u16, i16, i32, i64 = U16.unpack_from, I16.unpack_from, I32.unpack_from, I64.unpack_from
+        sizes = PAYLOAD_SIZES
+        buf, pos = b'', 0
+        path, frames = [], []  # keys and (counter, alive, selected) of the enclosing objects
+        counter = 0  # position of the next unnamed element
+        alive = [p for p in patterns if len(p) > 0]  # patterns still matching the current path
+        selected = not patterns  # whether the current object is at or below a subscribed path
+        pending = key = None  # scalar not yet known to be a key or an element, key waiting for its value
+
+        def descend(name):
+            """Returns the patterns still alive below name and whether name itself is subscribed"""
+            depth, s = len(path), str(name)
+            matching = [p for p in alive if fnmatchcase(s, p[depth])]
+            return [p for p in matching if len(p) > depth + 1], any(len(p) == depth + 1 for p in matching)
+
+        while True:
+            if len(buf) - pos < 16:
+                buf, pos = buf[pos:] + stream.read(block_size), 0
+                if len(buf) < 2:
+                    break
+            code = u16(buf, pos)[0]
+            pos += 2
+            if code == 1:
+                key, pending = pending, None
+                continue
+            if code == 3 or code == 4:
+                if pending is not None:
+                    if selected or descend(counter)[1]:
+                        yield 'value', tuple(path), counter, pending
+                    counter, pending = counter + 1, None
+                if code == 4:
+                    if not frames:  # closing brace of the object containing the stream
+                        return
+                    name = path.pop()
+                    if selected:
+                        yield 'end', tuple(path), name, None
+                    counter, alive, selected = frames.pop()
+                    continue
+                if key is None:
+                    name, counter = counter, counter + 1
+                else:
+                    name, key = key, None
+                child_alive, child_selected = ([], True) if selected else descend(name)
+                if child_selected or child_alive:
+                    if child_selected:
+                        yield 'start', tuple(path), name, None
+                    frames.append((counter, alive, selected))
+                    path.append(name)
+                    counter, alive, selected = 0, child_alive, child_selected
+                    continue
+                depth = 1  # nothing subscribed inside this object, skip it without decoding
+                while depth:
+                    if len(buf) - pos < 16:
+                        buf, pos = buf[pos:] + stream.read(block_size), 0
+                        if len(buf) < 2:
+                            return
+                    code = u16(buf, pos)[0]
+                    pos += 2
+                    if code == 3:
+                        depth += 1
+                    elif code == 4:
+                        depth -= 1
+                    elif code == 15 or code == 23:
+                        length = u16(buf, pos)[0]
+                        while len(buf) - pos < length + 2:
+                            more = stream.read(block_size)
+                            if not more:
+                                return
+                            buf, pos = buf[pos:] + more, 0
+                        pos += 2 + length
+                    else:
+                        pos += sizes.get(code, 0)
+                continue
+            if code == 20:
+                v = i32(buf, pos)[0]
+            elif code == 15 or code == 23:
+                length = i16(buf, pos)[0]
+                while len(buf) - pos < length + 2:
+                    more = stream.read(block_size)
+                    if not more:
+                        return
+                    buf, pos = buf[pos:] + more, 0
+                v = buf[pos + 2:pos + 2 + length].decode('windows-1252')
+                pos += length
+            elif code == 12:
+                v = decode_date(i32(buf, pos)[0])
+            elif code == 13:
+                v = i32(buf, pos)[0] / 1000
+            elif code == 14:
+                v = buf[pos] != 0
+            elif code == 359 or code == 400:
+                v = i64(buf, pos)[0] / 32768
+            else:
+                v = keys.get(code) or important_keys.get(code) or self.unknown_key(code)
+            pos += sizes.get(code, 2 if code == 15 or code == 23 else 0)
+            if key is not None:
+                if selected or descend(key)[1]:
+                    yield 'value', tuple(path), key, v
+                key = None
+            else:
+                if pending is not None:
+                    if selected or descend(counter)[1]:
+                        yield 'value', tuple(path), counter, pending
+                    counter += 1
+                pending = v
+        if pending is not None and (selected or descend(counter)[1]):
+            yield 'value', tuple(path), counter, pending
+
+    @classmethod
+    def get_pool(cls):
+        if cls.pool is None:
+            cls.pool = Pool(processes=cls.workers, initializer=cls.init_worker)
+            atexit.register(cls.close_pool)
+        return cls.pool
+
+    @classmethod
+    def close_pool(cls):
+        if cls.pool is not None:
+            cls.pool.close()
+            cls.pool.join()
+            cls.pool = None
+
+    @classmethod
+    def init_worker(cls):
+        cls(stream=None)  # loads keys and whitelist once per worker
+
+    @timing
+    def parse_parallel(self, content, bounds):
+        """Uses the worker pool to parse the items of a big top-level object found between bounds faster. The content is
+        copied once in shared memory and the items are split in chunks. Each worker decodes its chunks with the buffer
+        engine and sends back the result serialized with marshal."""
+        tasks = []
+        shm = shared_memory.SharedMemory(create=True, size=max(len(content), 1))
+        try:
+            shm.buf[:len(content)] = content
+            for group in np.array_split(np.arange(len(bounds)), min(self.workers * self.chunks_per_worker,
+                                                                    len(bounds))):
+                tasks.append((shm.name, bool(self.whitelist), merge_ranges(bounds[i] for i in group)))
+            container = {}
+            for result in self.get_pool().imap(parse_chunk, tasks):
+                result, skipped = marshal.loads(result)
+                container.update(result)
+                self.skipped.update(skipped)
+            return container
+        finally:
+            shm.close()
+            shm.unlink()
 
     def parse_player_country(self):
         b = self.stream.read()
@@ -147,41 +430,44 @@ class Parser:
 
     def assign(self):
         drop = self.whitelist and self.last_is_key and self.container.get_last() not in self.whitelist
-        self.read_code()
+        self.curr_code = self.unpack_data(2, '<H')
+        if drop and self.curr_code == 3:  # object dropped by the whitelist, skip it without building anything
+            self.skip_object()
+            self.save_data(SKIPPED)
+        else:
+            self.funcs[types.get(self.curr_code, Types.KEY)]()
         self.container.name_last(drop=drop)
 
+    def skip_object(self):
+        """Reads the stream up to the brace closing the object that was just opened without decoding anything"""
+        depth, tokens, size = 1, 1, 2
+        while depth:
+            code = self.unpack_data(2, '<H')
+            tokens += 1
+            size += 2
+            if code == 3:
+                depth += 1
+            elif code == 4:
+                depth -= 1
+            elif code == 15 or code == 23:
+                length = self.unpack_data(2, '<H')
+                self.stream.read(length)
+                size += 2 + length
+            else:
+                n = PAYLOAD_SIZES.get(code, 0)
+                self.stream.read(n)
+                size += n
+        self.skipped.add(self.container.get_last(), tokens, size)
+
     def open_object(self):
         self.container = ClausewitzObjectContainer(parent=self.container)
         self.container.parent.append(self.container)
 
     def close_object(self):
-        self.container.close()
-        self.container = self.container.parent
+        self.container = self.container.close()
 
     def read_date(self):
-        """https://gitgud.io/nixx/paperman/-/blob/master/paperman/src/Util/numberToDate.ts"""
-        # todo reverse this and store a map {int: date} pre-calculated so that this can return without calculations
-        n = self.unpack_data(4, "i")
-        zero_date = 43800000  # year 0. only 1.1.1 seems to be used in years between 0 and ~1300
-        if n < zero_date or n > 60000000:  # only parses dates between 1.1.1 and ~ 1850
-            if n == 43791240:
-                v = '-1.1.1'
-            else:
-                v = n
-        else:
-            n = (n - zero_date) // 24
-            year, n = divmod(n, 365)
-            month = day = 1
-            for m in range(1, 12):
-                _, month_length = calendar.monthrange(1995, m)
-                if n >= month_length:
-                    n -= month_length
-                    month += 1
-                else:
-                    break
-            day += n
-            v = f"{year}.{month}.{day}"
-        self.save_data(v)
+        self.save_data(decode_date(self.unpack_data(4, "i")))
 
     def read_int(self):
         v = self.unpack_data(4, "i")
@@ -213,39 +499,57 @@ class Parser:
                 self.save_data(k)
                 if not self.container.parent:  # top level object, split the content
                     self.read_code()  # read ={
-                    b = self.stream.read()
-                    # regex pattern used for multiprocessing
-                    if k == 'countries':
-                        # regex explanation: it uses positive lookahead to match until next country tag is found. For
-                        # this reason, a dummy tag is added at the end of the string for the last match to succeed.
-                        # Since a country tag can be found inside the active_relations section, we match
-                        # innovativeness (\\\xe27) first which ensures the whole country content to be matched.
-                        tag = b".{4}[A-Z0-9\-]{3}\\\x01\\000\\\x03\\000"  # <str_type><str_len>XXX={
-                        is_human = b'\\\xae\\\x2c\\\x01\\000' if self.human_only_countries else b''
-                        pattern = tag + is_human + b".*?\\\xe27\\\x01\\000.*?(?=" + tag + b")"
-                        end = b'\x04\x00\xda\x28\x01\x00\x03\x00'  # '}active_advisors={' as encoded by Clausewitz
-                        dummy_string = b"ttllFOO\x01\x00\x03\x00"
-                    elif k == 'provinces':
-                        # each province is identified with an int type. We find int indexes only as province identifiers
-                        # so it's safe to use the lazy dot operator to match the whole content
-                        tag = b'\x0c\x00.{4}\x01\x00\x03\x00'  # <int_type><4_int_bytes>={
-                        pattern = tag + b".*?(?=" + tag + b")"
-                        end = b'\x04\x00\x4e\x2e\x01\x00\x03\x00'  # '}countries={' as encoded by Clausewitz
-                        dummy_string = b"\x0c\x00IIII\x01\x00\x03\x00"
-                    else:
-                        raise ValueError
-                    match = re.search(re.escape(end), b, flags=re.DOTALL)
-                    split = match.start()
-                    content, remainder = (io.BytesIO(x) for x in (b[:split] + dummy_string, b[split:]))
-                    parser = Parser(stream=content, pattern=pattern)
-                    parser.parse()
-                    self.container.update(parser.container)
-                    self.stream = remainder
+                    self.read_section(k)
             except KeyError:
-                k = f"unknown_key_{hex(self.curr_code)}"
-                print(k, self.container.parent)
-                self.keys[self.curr_code] = k
-                self.save_data(k)
+                self.save_data(self.unknown_key(self.curr_code, self.container))
+
+    def read_section(self, name):
+        """Parses the content of a big top-level object window_size bytes at a time. The items of every window are found
+        by scan_object without decoding them, the window is cut at the start of its last item and the rest is carried
+        over to the next one, so that memory doesn't grow with the size of the section. Items are decoded by the worker
+        pool if there's more than one worker, in this process otherwise. Bytes read past the closing brace of the
+        section are given back to the stream."""
+        rest = b''
+        while True:
+            chunk = self.stream.read(self.window_size)
+            block = rest + chunk
+            view = memoryview(block)
+            end, _, found = scan_object(view, 0, levels=1)
+            closed = end < len(block)
+            offsets, codes, _ = found if found is not None else (np.zeros(0, dtype=np.int64),) * 3
+            starts = offsets[:-1][codes[1:] == 1].tolist()  # keys of 'key = value' items
+            if closed or not chunk:
+                stop = end
+                bounds = list(zip(starts, starts[1:] + [stop]))
+            else:  # the last item may continue in the next window
+                stop = starts[-1] if starts else 0
+                bounds = list(zip(starts[:-1], starts[1:]))
+            if self.human_only_countries and name == 'countries':
+                bounds = [(a, b) for a, b in bounds if self.is_human(view, a)]
+            if bounds and self.workers > 1:
+                self.container.update(self.parse_parallel(block[:stop], bounds))
+            else:
+                for first, last in merge_ranges(bounds):
+                    self.container.update(self.decode(view, first, last))
+            rest = block[stop:]
+            if closed or not chunk:
+                break
+        self.stream = io.BufferedReader(Prefixed(rest, self.stream))
+
+    def is_human(self, view, offset):
+        """Whether the item at offset is 'tag = {' followed by the key of the countries played by humans"""
+        code = U16.unpack_from(view, offset)[0]
+        if code == 15 or code == 23:
+            offset += 4 + U16.unpack_from(view, offset + 2)[0]
+        else:
+            offset += 2 + PAYLOAD_SIZES.get(code, 0)
+        return view[offset:offset + 4] == b'\x01\x00\x03\x00' and U16.unpack_from(view, offset + 4)[0] == self.human_key
+
+    def unknown_key(self, code, container=None):
+        k = f"unknown_key_{hex(code)}"
+        print(k, container.parent if container is not None else '')
+        self.keys[code] = k
+        return k
 
     def save_data(self, v):
         self.container.append(v)
@@ -255,78 +559,394 @@ class Parser:
 
     @classmethod
     @timing
-    def from_zip(cls, filename):
+    def from_zip(cls, filename, mode='stream'):
         with ZipFile(filename) as zf:
-            with zf.open('meta') as f:
-                meta = cls(stream=f, whitelist=False)
+            with open_entry(zf, 'meta') as f:
+                meta = cls(stream=f, whitelist=False, mode=mode)
                 meta.parse()
-            with zf.open('gamestate') as f:
-                gamestate = cls(stream=f, whitelist=True)
+            with open_entry(zf, 'gamestate') as f:
+                gamestate = cls(stream=f, whitelist=True, mode=mode)
                 gamestate.parse()
                 # gamestate.parse_player_country()
+        logger.debug(gamestate.skipped)
         return {"meta": meta.container, "gamestate": gamestate.container}
 
 
+def parse_chunk(task):
+    """Worker side of Parser.parse_parallel: decodes the ranges of the shared content and returns them marshalled"""
+    name, whitelist, ranges = task
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        parser = Parser(stream=None, whitelist=whitelist, mode='buffer')
+        result = {}
+        for start, end in ranges:
+            result.update(to_dict(parser.decode(shm.buf, start, end)))
+        return marshal.dumps((result, parser.skipped.keys))
+    finally:
+        shm.close()
+
+
+def merge_ranges(bounds):
+    """Joins contiguous (start, end) ranges, so that they're decoded in a single pass"""
+    ranges = []
+    for start, end in bounds:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def skip_object(view, offset):
+    """Scans view from the content of an object up to its closing brace without decoding anything. Returns the offset
+    following the brace and the number of tokens skipped, braces included. Objects longer than SCAN_TOKENS tokens are
+    finished by scan_object, which is much faster on big ones but has a fixed cost."""
+    u16, sizes = U16.unpack_from, PAYLOAD_SIZES
+    depth, tokens = 1, 1
+    while depth:
+        if tokens > SCAN_TOKENS:
+            end, scanned, _ = scan_object(view, offset, depth - 1)
+            return end + 2, tokens + scanned + 1
+        code = u16(view, offset)[0]
+        offset += 2
+        tokens += 1
+        if code == 3:
+            depth += 1
+        elif code == 4:
+            depth -= 1
+        elif code == 15 or code == 23:
+            offset += 2 + u16(view, offset)[0]
+        else:
+            offset += sizes.get(code, 0)
+    return offset, tokens
+
+
+def token_offsets(view, offset=0, end=None):
+    """Finds the tokens starting in view between offset, which must be the start of a token, and end without a Python
+    loop over them. The step to the next token is computed for every byte as if a token started there, then the buffer
+    is split in blocks and the chains of steps from the first two bytes of every block are followed all at once. Chains
+    starting in the same place as the previous block ended are the tokens, and since one of the two starts of a block
+    almost always joins them after a few tokens, only those few are followed one by one when stitching the blocks.
+    Returns the offsets and the codes of the tokens and the offset following the last one. Buffers longer than
+    SCAN_WINDOW are scanned a window at a time."""
+    end = len(view) if end is None else end
+    n = end - offset
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16), offset
+    if n > SCAN_WINDOW:
+        parts = []
+        while offset < end:
+            offsets, codes, offset = token_offsets(view, offset, min(offset + SCAN_WINDOW, end))
+            parts.append((offsets, codes))
+        return *(np.concatenate(a) for a in zip(*parts)), offset
+    block = 1 << max(9, min(13, n.bit_length() // 2))  # fewer iterations for small buffers, fewer blocks for big ones
+    m = n + 2 + n % 2
+    data = np.zeros(m + 2, dtype=np.uint8)
+    data[:min(len(view), end + 4) - offset] = np.frombuffer(view, np.uint8, min(len(view), end + 4) - offset, offset)
+    codes = np.empty(m, dtype=np.uint16)  # code of the token starting at every byte
+    codes[0::2] = data[:m].view('<u2')
+    codes[1::2] = data[1:m + 1].view('<u2')
+    steps = STEPS[codes]
+    strings = np.flatnonzero((codes[:n] == 15) | (codes[:n] == 23))
+    steps[strings] += codes[strings + 2]
+    starts = np.arange(0, n, block)
+    positions = np.minimum((starts[:, None] + np.arange(2)).ravel(), n)
+    ends = np.repeat(np.minimum(starts + block, n), 2)
+    bases = np.tile(np.arange(2) * (n + 1), len(starts))
+    chains = np.arange(len(positions))
+    exits = positions.copy()  # offset where every chain left its block
+    marks = np.zeros(2 * (n + 1), dtype=bool)  # bytes reached by the first and by the second chain of their block
+    while len(positions):
+        marks[bases + positions] = True
+        positions += steps[positions]
+        inside = positions < ends
+        if not inside.all():
+            exits[chains[~inside]] = positions[~inside]
+            positions, ends, bases, chains = positions[inside], ends[inside], bases[inside], chains[inside]
+    marks, exits = marks.reshape(2, n + 1), exits.reshape(-1, 2)
+    reached = marks[0] | marks[1]
+    tokens, extra, position = np.zeros(n, dtype=bool), [], 0
+    for i, start in enumerate(starts.tolist()):
+        stop = min(start + block, n)
+        while position < stop and not reached[position]:
+            extra.append(position)
+            position += int(steps[position])
+        if position < stop:
+            chain = 0 if marks[0, position] else 1
+            tokens[position:stop] = marks[chain, position:stop]
+            position = int(exits[i, chain])
+    tokens[extra] = True
+    found = np.flatnonzero(tokens)
+    return found + offset, codes[found], position + offset
+
+
+def scan_object(view, offset, depth=0, levels=0):
+    """Scans view from offset, inside an object where depth objects are still open, up to its closing brace without
+    decoding anything. Tokens are found by token_offsets a window at a time, with windows doubling up to SCAN_WINDOW
+    bytes. Returns the offset of the closing brace (the end of view if there's none), the number of tokens before it
+    and the (offsets, codes, depths) of the tokens nested less than levels objects deep, where the braces of an object
+    are at the depth of its key."""
+    window, tokens, parts = 1 << 16, 0, []
+    while offset < len(view) - 1:
+        offsets, codes, following = token_offsets(view, offset, min(offset + window, len(view) - 1))
+        depths = depth + np.cumsum((codes == 3).astype(np.int64) - (codes == 4))  # depth after every token
+        closing = np.flatnonzero(depths < 0)
+        if len(closing):
+            i = closing[0]
+            offsets, codes, depths, following = offsets[:i], codes[:i], depths[:i], int(offsets[i])
+        tokens += len(codes)
+        if levels:
+            nesting = depths - (codes == 3)  # braces are at the depth of the object containing them
+            selected = nesting < levels
+            parts.append((offsets[selected], codes[selected], nesting[selected]))
+        if len(closing):
+            break
+        offset, depth, window = following, int(depths[-1]) if len(depths) else depth, min(window * 2, SCAN_WINDOW)
+    else:
+        following = len(view)
+    found = tuple(np.concatenate(a) for a in zip(*parts)) if parts else None
+    return following, tokens, found
+
+
+def match_braces(codes, depths):
+    """Returns the index of the matching brace of every token, -1 for the tokens that aren't braces or aren't closed.
+    Braces of the same depth are sorted by position: every opening brace is matched by the closing brace after it."""
+    matches = np.full(len(codes), -1, dtype=np.int64)
+    braces = np.flatnonzero((codes == 3) | (codes == 4))
+    levels = depths[braces] + (codes[braces] == 4)
+    order = np.lexsort((braces, levels))
+    braces, levels = braces[order], levels[order]
+    pairs = (codes[braces[:-1]] == 3) & (codes[braces[1:]] == 4) & (levels[:-1] == levels[1:])
+    matches[braces[:-1][pairs]] = braces[1:][pairs]
+    matches[braces[1:][pairs]] = braces[:-1][pairs]
+    return matches
+
+
+def read_scalar(view, offset, keys):
+    """Decodes the scalar token at offset, keys are decoded using the names in keys"""
+    code = U16.unpack_from(view, offset)[0]
+    offset += 2
+    t = types.get(code, Types.KEY)
+    if t is Types.INT:
+        return I32.unpack_from(view, offset)[0]
+    elif t is Types.STR:
+        return str(view[offset + 2:offset + 2 + U16.unpack_from(view, offset)[0]], 'windows-1252')
+    elif t is Types.DATE:
+        return decode_date(I32.unpack_from(view, offset)[0])
+    elif t is Types.FLOAT:
+        return I32.unpack_from(view, offset)[0] / 1000
+    elif t is Types.BOOL:
+        return view[offset] != 0
+    elif t is Types.FLOAT5:
+        return I64.unpack_from(view, offset)[0] / 32768
+    elif t is Types.KEY:
+        return keys.get(code, f"unknown_key_{hex(code)}")
+    raise ValueError(f"token at offset {offset - 2} of type {t} has no value")
+
+
+class SkipReport:
+    """Objects skipped because their key is not in the whitelist: for every key it counts the objects, their tokens and
+    their bytes. Useful to see what the whitelist saves and tune it."""
+
+    def __init__(self):
+        self.keys = {}  # key -> [objects, tokens, bytes]
+
+    def add(self, key, tokens, size):
+        metrics.count('bytes_skipped', size)
+        counts = self.keys.setdefault(key, [0, 0, 0])
+        counts[0] += 1
+        counts[1] += tokens
+        counts[2] += size
+
+    def update(self, keys):
+        for key, (objects, tokens, size) in keys.items():
+            metrics.count('bytes_skipped', size)
+            counts = self.keys.setdefault(key, [0, 0, 0])
+            counts[0] += objects
+            counts[1] += tokens
+            counts[2] += size
+
+    @property
+    def tokens(self):
+        return sum(c[1] for c in self.keys.values())
+
+    @property
+    def bytes(self):
+        return sum(c[2] for c in self.keys.values())
+
+    def most_common(self, n=10):
+        return sorted(self.keys.items(), key=lambda item: item[1][2], reverse=True)[:n]
+
+    def __str__(self):
+        top = ", ".join(f"{k}={size / 2 ** 20:.2f}MB" for k, (_, _, size) in self.most_common(5))
+        return f"skipped {self.tokens} tokens ({self.bytes / 2 ** 20:.2f}MB) of non-whitelisted objects, top: {top}"
+
+
+def to_dict(container):
+    """Converts a container tree to plain dictionaries, which can be serialized by marshal"""
+    return {k: to_dict(v) if isinstance(v, dict) else v for k, v in container.items()}
+
+
+class Tape:
+    """Structural index of binary content built with a single pass over the buffer. For every token it stores its code,
+    type and offset, and for every brace the index of the matching one, so that any object can be located, skipped or
+    sliced in O(1) once the tape is built. Arrays are kept compact: uint16 codes, uint8 types, uint32 offsets and int32
+    matches (-1 for tokens that are not braces)."""
+
+    def __init__(self, view, codes, offsets, matches, end, keys=None):
+        self.view = view
+        self.codes = codes
+        self.kinds = KINDS[codes]
+        self.offsets = offsets
+        self.matches = matches
+        self.end = end  # offset where indexing stopped
+        self.keys = keys if keys is not None else {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    @timing
+    def from_buffer(cls, buffer, offset=0, keys=None):
+        """Indexes the buffer from offset. Tokens are found by token_offsets and braces are matched with array
+        operations."""
+        view = memoryview(buffer)
+        offsets, codes, end = token_offsets(view, offset)
+        if end > len(view):
+            raise ValueError(f"truncated token at offset {offsets[-1]}")
+        depths = np.cumsum((codes == 3).astype(np.int64) - (codes == 4))  # depth after every token
+        unmatched = np.flatnonzero(depths < 0)
+        if len(unmatched):
+            raise ValueError(f"unmatched closing brace at offset {offsets[unmatched[0]]}")
+        if len(depths) and depths[-1]:
+            raise ValueError(f"{depths[-1]} unclosed objects at end of content")
+        metrics.count('tokens_indexed', len(codes))
+        return cls(view, codes, offsets.astype(np.uint32), match_braces(codes, depths).astype(np.int32), end=end,
+                   keys=keys)
+
+    def skip(self, i):
+        """Returns the index of the token that follows the value starting at token i"""
+        return int(self.matches[i]) + 1 if self.codes[i] == 3 else i + 1
+
+    def end_offset(self, i):
+        j = self.skip(i)
+        return int(self.offsets[j]) if j < len(self) else self.end
+
+    def slice(self, i):
+        """Returns the bytes of the value starting at token i, braces included for objects"""
+        return self.view[int(self.offsets[i]):self.end_offset(i)]
+
+    def items(self, i=None):
+        """Yields (key, value) token indexes for the object opened at token i, or for the top level if i is None.
+        Unnamed elements (lists) are yielded with None as key."""
+        j, stop = (0, len(self)) if i is None else (i + 1, int(self.matches[i]))
+        codes = self.codes
+        while j < stop:
+            if j + 1 < stop and codes[j + 1] == 1:
+                yield j, j + 2
+                j = self.skip(j + 2)
+            else:
+                yield None, j
+                j = self.skip(j)
+
+    def find(self, *path, i=None):
+        """Returns the index of the value found following the keys in path, starting from the object at token i"""
+        for name in path:
+            for k, v in self.items(i):
+                if k is not None and self.value(k) == name:
+                    i = v
+                    break
+            else:
+                raise KeyError(name)
+        return i
+
+    def value(self, i):
+        """Decodes the scalar token at index i. Keys are decoded using the names in self.keys."""
+        return read_scalar(self.view, int(self.offsets[i]), self.keys)
+
+
 class ClausewitzObjectContainer(dict):
     """This is a dictionary that also behaves like a list in case the container does not have any assignments inside it,
-     using an integer index for keys. Integer keys are also used to temporary store unnamed elements before an assign
-     operation is executed. Since sometimes the same key is repeated, when the object is closed it will fix duplicate
-     keys by putting them inside another container. E.g. the 'advisor' key will be repeated 3 times, when the object is
-     closed it will contain 'advisors'={0: {...}, 1: {...}, 2: {...}}"""
+    using an integer index for keys. The last two items are kept aside until it's known whether they're a key and its
+    value: when an assign operation is executed they're stored as a pair, otherwise they become list elements. When
+    the same key is repeated its values are moved inside another container as soon as the repetition is found. E.g.
+    the 'advisor' key will be repeated 3 times and the object will contain 'advisors'={0: {...}, 1: {...}, 2: {...}}.
+    Keys that aren't strings, or whose group name is also a key of the object, keep only their last value."""
+    __slots__ = ('parent', 'pending', 'count', 'groups')
 
     def __init__(self, parent=None, **kwargs):
         super().__init__(**kwargs)
         self.parent = parent
-        self.i = 0
-        self.duplicate_keys = set()
-        self.contains_kw = False
+        self.pending = []  # items that can still become a key-value pair
+        self.count = 0  # index of the next list element
+        self.groups = None  # repeated keys, created on the first repetition
+
+    def add(self, item):
+        self[self.count] = item
+        self.count += 1
 
     def append(self, item):
-        self[self.i] = item
-        self.i += 1
+        pending = self.pending
+        if len(pending) == 2:  # the oldest item wasn't assigned, so it's a list element
+            self.add(pending.pop(0))
+        pending.append(item)
 
     def close(self):
-        if self.contains_kw:
-            del self[0]
-            del self[1]
-        for k, v in list(self.items()):
-            if v == {}:
-                del self[k]
-                continue
-            try:
-                stripped_key = k.rstrip()
-                if stripped_key in self.duplicate_keys:
-                    group_key = stripped_key + 's'
-                    group = self.setdefault(group_key, ClausewitzObjectContainer(parent=self))
-                    group.append(v)
-                    del self[k]
-            except AttributeError:  # key is an integer, rstrip() returned exception
-                pass
-        for k in self.duplicate_keys:
-            group_key = k + 's'
-            if group_key in self and len(self[group_key]) == 1:
-                self[k] = self[group_key][0]
-                del self[group_key]
-        self.duplicate_keys.clear()
+        """Stores the items left as list elements and removes the object from its parent if it's empty. Returns the
+        parent, which isn't referenced anymore to avoid keeping reference cycles."""
+        for item in self.pending:
+            self.add(item)
+        self.pending = None
+        parent, self.parent = self.parent, None
+        if not self and parent is not None:
+            parent.discard(self)
+        return parent
+
+    def discard(self, child):
+        """Removes an empty object that was just closed: it's the last item added, either directly or to a group"""
+        if self.pending and self.pending[-1] is child:
+            self.pending.pop()
+        elif self and self[next(reversed(self))] is child:
+            del self[next(reversed(self))]
+        else:
+            for k in self.groups or ():
+                group = self[k + 's']
+                if group and group.get(group.count - 1) is child:
+                    group.count -= 1
+                    del group[group.count]
 
     def name_last(self, drop=False):
-        try:
-            name = self[self.i - 2]
-            value = self[self.i - 1]
-            self.i -= 2
-            self.contains_kw = True
-            if drop:
-                return
-            if name in self and isinstance(name, str):
-                self.duplicate_keys.add(name)
-                while name in self:
-                    name += ' '
-            self[name] = value
-        except KeyError:
+        pending = self.pending
+        if len(pending) < 2:  # the value is the object just opened, the name is in the parent
             self.parent.name_last(drop=drop)
+            return
+        value = pending.pop()
+        name = pending.pop()
+        if drop:
+            return
+        if self.groups and name in self.groups:
+            self[name + 's'].add(value)
+        elif self.groups and isinstance(name, str) and name[-1:] == 's' and name[:-1] in self.groups:
+            # the name of a group is also a key of the object: the repeated key isn't grouped, its last value wins
+            group = self.pop(name)
+            self.groups.discard(name[:-1])
+            self[name[:-1]] = group[group.count - 1]
+            self[name] = value
+        elif name in self and isinstance(name, str) and name + 's' not in self:
+            group = self.setdefault(name + 's', ClausewitzObjectContainer())
+            group.add(self.pop(name))
+            group.add(value)
+            if self.groups is None:
+                self.groups = set()
+            self.groups.add(name)
+        else:
+            self[name] = value
 
     def get_last(self):
-        return self[self.i - 1]
+        return self.pending[-1]
+
+
+SKIPPED = ClausewitzObjectContainer()  # placeholder for the objects skipped by the whitelist, dropped at close
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+import datetime
+import json
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+
+from export import COUNTRY_COLUMNS, PROVINCE_COLUMNS, Columns
+
+# columns whose values are indexes in a dictionary of the Columns
+ENCODED = {name: 'tags' if t == 'tag' else name for name, t, _ in PROVINCE_COLUMNS + COUNTRY_COLUMNS
+           if t in ('tag', 'str')}
+ENCODED['tag'] = 'tags'
+
+
+class CampaignIndex:
+    """Indexes of the columns exported from a campaign, built once and shared by all the requests: tag -> country,
+    province id -> province, provinces sorted by owner (the provinces of an owner are a slice) and the owner changes of
+    the provinces sorted by date (the changes in a date range are a slice). Rulers are read from the save the first
+    time the ones of a country are requested."""
+
+    def __init__(self, columns, save_path=None):
+        self.columns = columns
+        self.save_path = save_path
+        provinces, countries = columns.provinces, columns.countries
+        tags = columns.dictionaries['tags']
+        self.countries_by_tag = {str(tags[t]): i for i, t in enumerate(countries['tag'])}
+        ids = provinces['id']
+        self.province_rows = np.full(int(ids.max(initial=0)) + 1, -1, dtype=np.int64)
+        self.province_rows[ids] = np.arange(len(ids))
+        self.by_owner = np.lexsort((ids, provinces['owner']))
+        self.owners = provinces['owner'][self.by_owner]
+        self.event_dates = np.asarray(columns.events['date'])  # sorted at export
+        self.event_rows = self.province_rows[columns.events['province']]
+        self.rulers_cache = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory):
+        return cls(Columns.load(os.path.join(directory, 'columns')), os.path.join(directory, 'save.eu4'))
+
+    def record(self, table, i):
+        """Returns the row i of table as a dict, with strings instead of dictionary indexes and None for missing
+        values"""
+        row = {}
+        for name in table.dtype.names:
+            value = table[name][i].item()
+            if name in ENCODED:
+                value = str(self.columns.dictionaries[ENCODED[name]][value]) if value >= 0 else None
+            elif name == 'last_conquest':
+                value = datetime.date.fromordinal(value).isoformat()
+            elif isinstance(value, float) and np.isnan(value):
+                value = None
+            row[name] = value
+        return row
+
+    def country(self, tag):
+        return self.record(self.columns.countries, self.countries_by_tag[tag])
+
+    def province(self, province_id):
+        row = self.province_rows[province_id] if 0 <= province_id < len(self.province_rows) else -1
+        if row < 0:
+            raise KeyError(province_id)
+        return self.record(self.columns.provinces, row)
+
+    def owned_by(self, tag):
+        """Rows of the provinces owned by tag, sorted by id"""
+        if tag not in self.countries_by_tag:
+            raise KeyError(tag)
+        owner = self.columns.tag_indexes[tag]
+        return self.by_owner[np.searchsorted(self.owners, owner, 'left'):np.searchsorted(self.owners, owner, 'right')]
+
+    def conquered_between(self, start=None, end=None):
+        """Rows of the provinces whose owner changed between the dates start and end (included), sorted by the date of
+        their first change in the range"""
+        first = np.searchsorted(self.event_dates, start.toordinal(), 'left') if start else 0
+        last = np.searchsorted(self.event_dates, end.toordinal(), 'right') if end else len(self.event_dates)
+        rows = self.event_rows[first:last]
+        _, firsts = np.unique(rows, return_index=True)
+        return rows[np.sort(firsts)]
+
+    def provinces(self, rows):
+        return (self.record(self.columns.provinces, i) for i in rows)
+
+    def rulers(self, tag):
+        if tag not in self.countries_by_tag:
+            raise KeyError(tag)
+        with self.lock:
+            if tag in self.rulers_cache:
+                return self.rulers_cache[tag]
+        rulers = self.read_rulers(tag)  # outside the lock, reading the save can take seconds
+        with self.lock:
+            return self.rulers_cache.setdefault(tag, rulers)
+
+    def read_rulers(self, tag):
+        from cache import SaveCache
+        from models import Country, DummyCountryException
+        from util import get_date
+        save = SaveCache().load(self.save_path)
+        try:
+            country = Country(tag=tag, **save['gamestate']['countries'][tag])
+            country.get_ruler_history(get_date(save['meta']['date']))
+        except DummyCountryException:
+            return []
+        return [{k: v.tolist() if hasattr(v, 'tolist') else v for k, v in r.__dict__.items()} for r in country.rulers]
+
+
+class CampaignIndexes:
+    """Indexes of the campaigns of the last used jobs, at most size of them"""
+
+    def __init__(self, size=8):
+        self.size = size
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, directory):
+        with self.lock:
+            if directory in self.indexes:
+                self.indexes.move_to_end(directory)
+                return self.indexes[directory]
+        index = CampaignIndex.load(directory)
+        with self.lock:
+            self.indexes[directory] = index
+            while len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+        return index
+
+
+def stream_page(items, total, offset, limit):
+    """Yields the JSON of a page of items in pieces, so that the response is never built as a whole"""
+    yield f'{{"total": {total}, "offset": {offset}, "limit": {limit}, "items": ['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item, default=lambda o: dict(o) if isinstance(o, Mapping) else str(o))
+    yield ']}'
+
+
+indexes = CampaignIndexes()
@@ -0,0 +1,146 @@
+import csv
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from src import ASSETS_DIR
+
+
+def rgb_to_int32(pixels):
+    pixels = pixels.astype(np.int32)
+    return (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+
+def read_definitions(path=f"{ASSETS_DIR}/definition.csv"):
+    """Returns the (province id, name) of the colors of definition.csv, keyed by color as int32"""
+    definitions = {}
+    with open(path, encoding='windows-1252') as f:
+        for line in csv.DictReader(f, delimiter=';'):
+            color = (int(line['red']) << 16) | (int(line['green']) << 8) | int(line['blue'])
+            definitions[color] = (int(line['province']), line['name'])
+    return definitions
+
+
+def save_array(path, array):
+    """Saves array in a temporary file renamed to path, so that concurrent builds never leave a half-written file for
+    readers to map"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def color_labels(pixels, ids):
+    """Returns the raster of the province ids (uint16) of the rgb pixels, ids maps int32 colors to ids. Pixels of
+    unknown colors are 0."""
+    colors = np.array(sorted(ids), dtype=np.int32)
+    values = np.array([ids[c] for c in colors], dtype=np.uint16)
+    pixels = rgb_to_int32(pixels)
+    positions = np.searchsorted(colors, pixels).clip(max=len(colors) - 1)
+    return np.where(colors[positions] == pixels, values[positions], 0).astype(np.uint16)
+
+
+class MapRenderer:
+    """Paints provinces over provinces_bordered.png using a raster of province ids (uint16, 0 for borders and unknown
+    colors) built once from provinces.png and definition.csv. A render builds a color lookup table indexed by province
+    id and paints the whole map with a single lut[labels] operation. Crop boxes come from the precomputed bounding box
+    of every province."""
+    labels_path = f"{ASSETS_DIR}/province_labels.npy"
+    boxes_path = f"{ASSETS_DIR}/province_boxes.npy"
+    sources = (f"{ASSETS_DIR}/provinces.png", f"{ASSETS_DIR}/provinces_bordered.png", f"{ASSETS_DIR}/definition.csv")
+
+    def __init__(self):
+        if self.outdated():
+            self.build()
+        self.labels = np.load(self.labels_path, mmap_mode='r')
+        self.boxes = np.load(self.boxes_path, mmap_mode='r')  # id -> (top, left, bottom, right), bottom/right excluded
+        self.base = np.array(Image.open(self.sources[1]))
+
+    @classmethod
+    def outdated(cls):
+        built = min((os.path.getmtime(p) for p in (cls.labels_path, cls.boxes_path) if os.path.exists(p)), default=0)
+        return not built or any(os.path.getmtime(p) > built for p in cls.sources)
+
+    @classmethod
+    def build(cls):
+        ids = {color: province_id for color, (province_id, _) in read_definitions(cls.sources[2]).items()}
+        labels = color_labels(np.array(Image.open(cls.sources[0])), ids)
+        bordered = np.array(Image.open(cls.sources[1]))
+        labels[(bordered == 0).all(axis=-1)] = 0  # borders are never painted
+        save_array(cls.boxes_path, cls.bounding_boxes(labels))
+        save_array(cls.labels_path, labels)
+
+    @staticmethod
+    def bounding_boxes(labels):
+        h, w = labels.shape
+        n = int(labels.max()) + 1
+        boxes = np.empty((n, 4), dtype=np.int32)
+        boxes[:, :2] = (h, w)
+        boxes[:, 2:] = 0
+        rows, cols = np.indices(labels.shape, sparse=True)
+        flat = labels.ravel()
+        np.minimum.at(boxes[:, 0], flat, np.broadcast_to(rows, labels.shape).ravel())
+        np.minimum.at(boxes[:, 1], flat, np.broadcast_to(cols, labels.shape).ravel())
+        np.maximum.at(boxes[:, 2], flat, np.broadcast_to(rows + 1, labels.shape).ravel())
+        np.maximum.at(boxes[:, 3], flat, np.broadcast_to(cols + 1, labels.shape).ravel())
+        return boxes
+
+    def lut(self, colors):
+        """Returns the lookup table of the colors of province ids, and the mask of the ones that are painted"""
+        lut = np.zeros((len(self.boxes), 3), dtype=np.uint8)
+        painted = np.zeros(len(self.boxes), dtype=bool)
+        if colors:
+            ids = np.fromiter(colors.keys(), dtype=np.int64, count=len(colors))
+            known = ids < len(self.boxes)
+            lut[ids[known]] = np.array(list(colors.values()), dtype=np.uint8)[known]
+            painted[ids[known]] = True
+        return lut, painted
+
+    def render(self, colors, box=None):
+        """Returns the pixels of the map with the provinces in colors (id -> rgb) painted. When a (left, top, right,
+        bottom) box is given only that part of the map is rendered."""
+        lut, painted = self.lut(colors)
+        labels, base = self.labels, self.base
+        if box is not None:
+            left, top, right, bottom = box
+            labels, base = labels[top:bottom, left:right], base[top:bottom, left:right]
+        return np.where(painted[labels][..., None], lut[labels], base)
+
+    def crop_box(self, ids, margin):
+        """Returns the (left, top, right, bottom) box containing the provinces in ids, with margin pixels around"""
+        h, w = self.labels.shape
+        ids = np.array([i for i in ids if i < len(self.boxes)], dtype=np.int64)
+        if not len(ids):
+            return 0, 0, w, h
+        boxes = self.boxes[ids]
+        boxes = boxes[boxes[:, 2] > boxes[:, 0]]  # provinces that are on the map
+        if not len(boxes):
+            return 0, 0, w, h
+        top, left = boxes[:, 0].min(), boxes[:, 1].min()
+        bottom, right = boxes[:, 2].max(), boxes[:, 3].max()
+        return (int(max(left - margin, 0)), int(max(top - margin, 0)),
+                int(min(right + margin, w)), int(min(bottom + margin, h)))
+
+    def share(self):
+        """Copies the rasters in shared memory. Returns the blocks, which the caller has to close and unlink, and the
+        spec that attach uses to build a renderer over them in another process without copying them."""
+        blocks, spec = [], {}
+        for name in ('labels', 'boxes', 'base'):
+            array = getattr(self, name)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            blocks.append(block)
+            spec[name] = (block.name, array.shape, array.dtype.str)
+        return blocks, spec
+
+    @classmethod
+    def attach(cls, spec):
+        renderer = cls.__new__(cls)
+        renderer.blocks = []  # keeps the mappings alive
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            renderer.blocks.append(block)
+            setattr(renderer, name, np.ndarray(shape, dtype, buffer=block.buf))
+        return renderer
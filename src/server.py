@@ -1,14 +1,235 @@
+import gzip
+import hashlib
 import logging
+import math
+import os
+from functools import lru_cache
 
-from flask import Blueprint, current_app
+from flask import (Blueprint, Response, abort, current_app, g, jsonify, request, send_file, stream_with_context,
+                   url_for)
 
-from util import render_template_wrapper
+import geometry
+import jobs
+import query
+from metrics import metrics, profiling_enabled, Profile
+from tiles import tile_server
+from util import get_date, render_template_wrapper
 
 server = Blueprint('server', __name__)
 logger = logging.getLogger(__name__)
 
 
+@server.record_once
+def configure(state):
+    # bodies bigger than this are refused with 413 before being read, so that a request can't fill the job directory
+    if state.app.config.get('MAX_CONTENT_LENGTH') is None:
+        state.app.config['MAX_CONTENT_LENGTH'] = jobs.MAX_UPLOAD_SIZE
+
+
+@server.before_app_request
+def start_request():
+    g.span = metrics.span(f"request:{request.endpoint}")
+    g.span.__enter__()
+    # clients can only ask for a profile, which is written to the disk of the server, when the app allows it
+    allowed = current_app.debug or current_app.config.get('PROFILE_REQUESTS')
+    g.profile = Profile(request.path).__enter__() if profiling_enabled(request.headers if allowed else None) else None
+
+
+@server.teardown_app_request
+def end_request(exc=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.__exit__(None, None, None)
+        logger.info(f"profile of {request.path} saved in {profile.path}\n{profile.summary()}")
+    span = g.pop('span', None)
+    if span is not None:
+        span.__exit__(None, None, None)
+    metrics.count('requests')
+    metrics.flush()
+
+
+@lru_cache(maxsize=None)
+def index_page():
+    """The index doesn't depend on the request, it's rendered once and its etag is the hash of the html"""
+    html = render_template_wrapper("index.html")[0]
+    return html, hashlib.sha256(html.encode()).hexdigest()[:32]
+
+
+def conditional(response, etag, max_age):
+    """Adds a strong etag and the cache headers to response, turning it into a 304 if the client has it already"""
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def get_payload(gzipped, etag):
+    """Response of a gzipped JSON payload, decompressed for the clients that don't accept gzip"""
+    accepted = 'gzip' in request.accept_encodings
+    response = Response(gzipped if accepted else gzip.decompress(gzipped), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if accepted:
+        response.content_encoding = 'gzip'
+    return conditional(response, f"{etag}-gzip" if accepted else etag, max_age=3600)
+
+
 @server.route('/', methods=['GET'])
 def home():
-    provinces_geojson = current_app.config["PROVINCES_GEOJSON_RAW"]
-    return render_template_wrapper("index.html", source=provinces_geojson)
+    html, etag = index_page()
+    return conditional(Response(html, mimetype='text/html'), etag, max_age=300)
+
+
+@server.route('/geometry/provinces.topojson', methods=['GET'])
+def get_provinces_geometry():
+    """Quantized TopoJSON of the provinces, sent gzipped as it is stored to the clients that accept it"""
+    payload = geometry.provinces.load()
+    return get_payload(payload.gzipped, payload.etag)
+
+
+@server.route('/geometry/provinces/<int(signed=True):z>.topojson', methods=['GET'])
+def get_provinces_geometry_level(z):
+    """TopoJSON of the provinces simplified for zoom z. With ?bbox=west,south,east,north only the provinces that
+    intersect it are sent."""
+    payload = geometry.levels[geometry.level(z)].load()
+    bbox = request.args.get('bbox')
+    if bbox is None:
+        return get_payload(payload.gzipped, payload.etag)
+    try:
+        bounds = [float(b) for b in bbox.split(',')]
+        if len(bounds) != 4 or not all(math.isfinite(b) for b in bounds) or bounds[0] > bounds[2] or \
+                bounds[1] > bounds[3]:
+            raise ValueError
+    except ValueError:
+        abort(400, "bbox must be west,south,east,north, finite with west <= east and south <= north")
+    return get_payload(*payload.clipped(bounds))
+
+
+@server.route('/jobs', methods=['POST'])
+def create_job():
+    """Uploads the .eu4 file of the 'save' field and queues its processing. Returns the status of the job, 202 if it
+    was created or 200 if the save was already uploaded."""
+    upload = request.files.get('save')
+    if upload is None:
+        abort(400, "the save must be uploaded in the 'save' field")
+    try:
+        status, created = jobs.queue.submit(upload.stream)
+    except jobs.QueueFull as e:
+        return jsonify(error=str(e)), 503, {'Retry-After': '30'}
+    location = url_for('server.get_job', job_id=status['id'])
+    return jsonify(status), 202 if created else 200, {'Location': location}
+
+
+@server.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        return jsonify(jobs.queue.status(job_id))
+    except KeyError:
+        abort(404)
+
+
+@server.route('/jobs/<job_id>/<any("result.json", "heatmap.png"):name>', methods=['GET'])
+def get_job_file(job_id, name):
+    """Files made by a finished job, 409 while it's pending or if it failed"""
+    try:
+        status = jobs.queue.status(job_id)
+    except KeyError:
+        abort(404)
+    if status['state'] != 'done':
+        return jsonify(status), 409
+    try:
+        return send_file(jobs.queue.path(job_id, name), max_age=86400)  # results of a save never change
+    except KeyError:
+        abort(404)
+
+
+def campaign_index(job_id):
+    """Index of the campaign of a finished job, 404 if there's none"""
+    try:
+        if jobs.queue.status(job_id)['state'] == 'done':
+            return query.indexes.get(jobs.queue.job_directory(job_id))
+    except KeyError:
+        pass
+    abort(404)
+
+
+def page(rows, records):
+    """Streamed response of the page of rows selected by the offset and limit arguments, records turns rows into
+    dicts"""
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if offset < 0 or not 0 < limit <= 10000:
+        abort(400, "offset must be >= 0 and limit between 1 and 10000")
+    items = records(rows[offset:offset + limit])
+    return Response(stream_with_context(query.stream_page(items, len(rows), offset, limit)),
+                    mimetype='application/json')
+
+
+@server.route('/campaigns/<job_id>/countries/<tag>', methods=['GET'])
+def get_country(job_id, tag):
+    try:
+        return jsonify(campaign_index(job_id).country(tag))
+    except KeyError:
+        abort(404)
+
+
+@server.route('/campaigns/<job_id>/countries/<tag>/provinces', methods=['GET'])
+def get_country_provinces(job_id, tag):
+    index = campaign_index(job_id)
+    try:
+        return page(index.owned_by(tag), index.provinces)
+    except KeyError:
+        abort(404)
+
+
+@server.route('/campaigns/<job_id>/countries/<tag>/rulers', methods=['GET'])
+def get_country_rulers(job_id, tag):
+    try:
+        rulers = campaign_index(job_id).rulers(tag)
+    except KeyError:
+        abort(404)
+    return page(rulers, iter)
+
+
+@server.route('/campaigns/<job_id>/provinces/<int:province_id>', methods=['GET'])
+def get_province(job_id, province_id):
+    try:
+        return jsonify(campaign_index(job_id).province(province_id))
+    except KeyError:
+        abort(404)
+
+
+@server.route('/campaigns/<job_id>/provinces', methods=['GET'])
+def get_provinces(job_id):
+    """Provinces whose owner changed between the optional from and to dates, sorted by the date of their first change"""
+    index = campaign_index(job_id)
+    try:
+        start, end = (get_date(request.args[k]) if k in request.args else None for k in ('from', 'to'))
+    except ValueError:
+        abort(400, "dates must be YYYY-MM-DD or YYYY.MM.DD")
+    return page(index.conquered_between(start, end), index.provinces)
+
+
+@server.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Spans and counters of every worker process and their totals"""
+    return jsonify(metrics.collect())
+
+
+@server.route('/tiles/<layer>/<int(signed=True):z>/<int(signed=True):x>/<int(signed=True):y>.png', methods=['GET'])
+def get_tile(layer, z, x, y):
+    try:
+        png = tile_server.get(layer, z, x, y)
+    except (KeyError, ValueError):
+        abort(404)
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'public, max-age=86400'})
+
+
+@server.route('/tiles/<job_id>/<layer>/<int(signed=True):z>/<int(signed=True):x>/<int(signed=True):y>.png',
+              methods=['GET'])
+def get_job_tile(job_id, layer, z, x, y):
+    """Tile of a conquest layer of the campaign of a finished job, see the layers of its result"""
+    try:
+        png = tile_server.get(layer, z, x, y, os.path.dirname(jobs.queue.path(job_id, 'layers.json')))
+    except (KeyError, ValueError):
+        abort(404)
+    return Response(png, mimetype='image/png', headers={'Cache-Control': 'public, max-age=86400'})
@@ -0,0 +1,42 @@
+// Decodes the features of the first object of a TopoJSON topology, quantized or not.
+function topojsonFeatures(topology) {
+    var transform = topology.transform || {scale: [1, 1], translate: [0, 0]};
+    var scale = transform.scale, translate = transform.translate;
+    var arcs = topology.arcs.map(function (arc) {
+        var x = 0, y = 0;
+        return arc.map(function (point) {
+            if (topology.transform) {  // quantized arcs are delta-encoded
+                x += point[0];
+                y += point[1];
+            } else {
+                x = point[0];
+                y = point[1];
+            }
+            return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+        });
+    });
+
+    function ring(indexes) {
+        var points = [];
+        indexes.forEach(function (i, k) {
+            var arc = i < 0 ? arcs[~i].slice().reverse() : arcs[i];
+            points = points.concat(k ? arc.slice(1) : arc);  // consecutive arcs share their end points
+        });
+        return points;
+    }
+
+    var object = topology.objects[Object.keys(topology.objects)[0]];
+    return object.geometries.filter(function (geometry) {
+        return geometry.arcs;  // geometries simplified away have none
+    }).map(function (geometry) {
+        var coordinates = geometry.type === 'Polygon' ? geometry.arcs.map(ring) :
+            geometry.arcs.map(function (polygon) {
+                return polygon.map(ring);
+            });
+        return {
+            type: 'Feature',
+            properties: geometry.properties,
+            geometry: {type: geometry.type, coordinates: coordinates}
+        };
+    });
+}
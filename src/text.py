@@ -0,0 +1,156 @@
+import calendar
+import re
+import struct
+import time
+
+# a token is a quoted string (with escaped characters, unrolled to avoid an alternation per character), an operator or
+# a run of anything else up to the next separator
+TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}=]|[^\s{}="]+')
+ESCAPED = re.compile(rb'\\([\\"])')  # only quotes and backslashes are escaped, other backslashes are kept as they are
+DATE = re.compile(rb'-?\d+\.\d+\.\d+')
+FLOAT = re.compile(rb'-?\d*\.(\d+)')
+INT = re.compile(rb'-?\d+')
+MONTH_STARTS = [sum(calendar.monthrange(1995, m)[1] for m in range(1, month)) for month in range(1, 13)]
+OPERATORS = {b'=': b'\x01\x00', b'{': b'\x03\x00', b'}': b'\x04\x00', b'yes': b'\x0e\x00\x01', b'no': b'\x0e\x00\x00'}
+
+
+def encode_date(year, month, day):
+    """Inverse of parser.decode_date"""
+    if (year, month, day) == (-1, 1, 1):
+        return 43791240
+    return 43800000 + (year * 365 + MONTH_STARTS[month - 1] + day - 1) * 24
+
+
+def encode_string(s, code=15):
+    if len(s) > 0xffff:
+        raise ValueError(f"string of {len(s)} bytes starting with {s[:20]!r}, binary tokens hold at most 65535")
+    return struct.pack('<HH', code, len(s)) + s
+
+
+def escape(s):
+    """Inverse of the unescaping of the quoted strings done by Transcoder.encode"""
+    return s.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+
+
+class Transcoder(dict):
+    """Converts plaintext (EU4txt) content to the binary token stream of ironman saves, so that text saves go through
+    the same containers, tapes and events as binary ones. Tokens are found in bulk with a single regex and mapped to
+    their binary form through this dict, which encodes every distinct token only once: saves repeat the same keys and
+    values over and over, so the whole conversion runs as C-level lookups and a single join."""
+
+    def __init__(self, keys):
+        super().__init__(OPERATORS)
+        self.keys = keys  # name -> code, only the string keys are used
+
+    def __missing__(self, token):
+        v = self[token] = self.encode(token)
+        return v
+
+    def transcode(self, data):
+        return b''.join(map(self.__getitem__, TOKEN.findall(data)))
+
+    def encode(self, token):
+        if token[0] == 34:  # '"'
+            return encode_string(ESCAPED.sub(rb'\1', token[1:-1]))
+        if DATE.fullmatch(token):
+            year, month, day = map(int, token.split(b'.'))
+            if 1 <= month <= 12 and 1 <= day <= 31 and (year > 0 or year == -1):
+                return struct.pack('<Hi', 12, encode_date(year, month, day))
+            return encode_string(token, 23)
+        if INT.fullmatch(token):
+            n = int(token)
+            return struct.pack('<Hi', 20, n) if -2 ** 31 <= n < 2 ** 31 else encode_string(token, 23)
+        if m := FLOAT.fullmatch(token):
+            if len(m.group(1)) <= 3:
+                return struct.pack('<Hi', 13, round(float(token) * 1000))
+            return struct.pack('<Hq', 400, round(float(token) * 32768))
+        code = self.keys.get(token.decode('windows-1252'))
+        return struct.pack('<H', code) if isinstance(code, int) else encode_string(token, 23)
+
+
+def transcode(data, keys):
+    return Transcoder(keys).transcode(data)
+
+
+def to_text(buffer, offset=6):
+    """Writes the binary content of buffer as a plaintext save, used to produce text saves for the benchmarks"""
+    from parser import Parser, PAYLOAD_SIZES, I32, I64, U16, decode_date
+    Parser(stream=None)
+    keys = Parser.all_keys
+    view = memoryview(buffer)
+    out = [b'EU4txt\n']
+    end = len(view) - 1
+    while offset < end:
+        code = U16.unpack_from(view, offset)[0]
+        offset += 2
+        if code == 1:
+            out.append(b'=')
+            continue
+        elif code == 3:
+            v = b'{'
+        elif code == 4:
+            v = b'}'
+        elif code == 15 or code == 23:
+            length = U16.unpack_from(view, offset)[0]
+            v = b'"' + escape(bytes(view[offset + 2:offset + 2 + length])) + b'"'
+            offset += 2 + length
+        elif code == 12:
+            v = str(decode_date(I32.unpack_from(view, offset)[0])).encode()
+        elif code == 20:
+            v = str(I32.unpack_from(view, offset)[0]).encode()
+        elif code == 13:
+            v = f"{I32.unpack_from(view, offset)[0] / 1000:.3f}".encode()
+        elif code == 14:
+            v = b'yes' if view[offset] else b'no'
+        elif code == 359 or code == 400:
+            v = f"{I64.unpack_from(view, offset)[0] / 32768:.5f}".encode()
+        else:
+            name = keys.get(code) or Parser.important_keys.get(code) or f"unknown_key_{hex(code)}"
+            v = str(name).encode('windows-1252')
+        offset += PAYLOAD_SIZES.get(code, 0)
+        if out[-1] == b'=':
+            out.append(v)
+        else:
+            out.append(b'\n' + v)
+    return b''.join(out)
+
+
+def convert(filename, output):
+    """Writes the gamestate of the binary save filename as an uncompressed plaintext save"""
+    from zipfile import ZipFile
+    with ZipFile(filename) as zf:
+        binary = zf.read('gamestate')
+    with open(output, 'wb') as f:
+        f.write(to_text(binary))
+
+
+def benchmark(filename, repeat=3):
+    """Measures the throughput of the tokenizer alone and of the whole parsing of the plaintext save filename"""
+    from parser import Parser, Tape
+    with open(filename, 'rb') as f:
+        data = f.read()
+    Parser(stream=None)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = transcode(data[6:], Parser.keys)
+        best = min(best, time.perf_counter() - start)
+    tokens = len(Tape.from_buffer(out))
+    size = len(data) / 2 ** 20
+    print(f"tokenizer: {size:.1f}MB, {tokens} tokens, best of {repeat}: {best:.3f}s, "
+          f"{size / best:.1f}MB/s, {tokens / best / 1e6:.2f}M tokens/s")
+    for mode in Parser.modes:
+        with open(filename, 'rb') as f:
+            start = time.perf_counter()
+            Parser(stream=f, mode=mode).parse()
+            elapsed = time.perf_counter() - start
+        print(f"parse ({mode}): {elapsed:.3f}s, {size / elapsed:.1f}MB/s")
+
+
+if __name__ == '__main__':
+    import os
+    from src import ASSETS_DIR
+    text_save = f"{ASSETS_DIR}/dharma_text.eu4"
+    if not os.path.exists(text_save):
+        convert(f"{ASSETS_DIR}/dharma.eu4", text_save)
+    benchmark(text_save)
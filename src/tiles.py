@@ -0,0 +1,217 @@
+import argparse
+import io
+import os
+import threading
+from collections import OrderedDict
+from functools import cached_property
+
+from PIL import Image
+
+from jobs import read_json
+from metrics import metrics
+from render import MapRenderer
+from src import ASSETS_DIR, PROJECT_ROOT
+
+MAP_WIDTH, MAP_HEIGHT = 5632, 2048
+TILE_SIZE = 256
+MIN_ZOOM, MAX_ZOOM = -2, 5
+OFFSET = 5  # of the L.Transformation(1, 5, -1, 5) of the CRS in index.html
+
+
+def tile_box(z, x, y):
+    """Returns the (left, top, right, bottom) box of the map covered by a tile. The CRS of index.html projects lng, lat
+    to the pixel (2^z * (lng + 5), 2^z * (5 - lat)), and the top row of the map is at lat = MAP_HEIGHT."""
+    size = TILE_SIZE / 2 ** z
+    left, top = x * size - OFFSET, y * size - OFFSET + MAP_HEIGHT
+    return left, top, left + size, top + size
+
+
+def tile_range(z):
+    """Returns the ranges of the x and y of the tiles that cover the map at zoom z"""
+    size = TILE_SIZE / 2 ** z
+    return (range(int(OFFSET // size), int((MAP_WIDTH + OFFSET) // size) + 1),
+            range(int((OFFSET - MAP_HEIGHT) // size), int(OFFSET // size) + 1))
+
+
+def resample(source, size):
+    return Image.NEAREST if size[0] >= source else Image.BOX
+
+
+class ImageLayer:
+    """Layer of an image stretched over the whole map, which can have a different resolution than the map"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @cached_property
+    def image(self):
+        return Image.open(self.path).convert('RGBA')
+
+    def render(self, box, size):
+        sx, sy = self.image.width / MAP_WIDTH, self.image.height / MAP_HEIGHT
+        left, top, right, bottom = box
+        return self.image.resize(size, resample((right - left) * sx, size),
+                                 box=(left * sx, top * sy, right * sx, bottom * sy))
+
+
+class ProvinceLayer:
+    """Layer of the provinces in colors (id -> rgb) painted over the bordered map by a MapRenderer"""
+    renderer = None  # shared by all the layers, created on first use
+
+    def __init__(self, colors=None):
+        self.colors = colors or {}
+
+    def render(self, box, size):
+        if ProvinceLayer.renderer is None:
+            ProvinceLayer.renderer = MapRenderer()
+        image = Image.fromarray(self.renderer.render(self.colors, box)).convert('RGBA')
+        return image.resize(size, resample(image.width, size))
+
+
+class TileServer:
+    """Renders the z/x/y PNG tiles of the layers for the CRS of index.html on demand. Tiles are kept in a LRU memory
+    cache of at most max_bytes, backed by <layer directory>/<z>/<x>/<y>.png on disk: directory/<layer> for the static
+    layers, <job directory>/tiles/<layer> for the layers of the campaign of a job. The layers of a job are read from the
+    layers.json written by process_save, so that every worker process can serve them, and the max_layers most recently
+    used are kept in memory."""
+
+    def __init__(self, directory=f"{ASSETS_DIR}/tiles", max_bytes=64 << 20, max_layers=16):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_layers = max_layers
+        self.layers = {}
+        self.job_layers = OrderedDict()  # (job directory, layer) -> layer
+        self.memory = OrderedDict()  # (layer directory, z, x, y) -> png
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @cached_property
+    def empty(self):
+        return self.encode(Image.new('RGBA', (TILE_SIZE, TILE_SIZE)))
+
+    def add_layer(self, name, layer):
+        self.layers[name] = layer
+
+    def layer(self, name, job_directory=None):
+        """Returns a layer and the directory of its tiles, raising KeyError for unknown layers"""
+        if job_directory is None:
+            return self.layers[name], os.path.join(self.directory, name)
+        key = (job_directory, name)
+        with self.lock:
+            layer = self.job_layers.get(key)
+            if layer is not None:
+                self.job_layers.move_to_end(key)
+                return layer, os.path.join(job_directory, 'tiles', name)
+        colors = (read_json(os.path.join(job_directory, 'layers.json')) or {})[name]
+        layer = ProvinceLayer({int(i): tuple(rgb) for i, rgb in colors.items()})
+        with self.lock:
+            self.job_layers[key] = layer
+            while len(self.job_layers) > self.max_layers:
+                self.job_layers.popitem(last=False)
+        return layer, os.path.join(job_directory, 'tiles', name)
+
+    @staticmethod
+    def path(directory, z, x, y):
+        return os.path.join(directory, str(z), str(x), f"{y}.png")
+
+    def get(self, name, z, x, y, job_directory=None):
+        """Returns the PNG of a tile of a static layer, or of a layer of the job in job_directory, raising KeyError for
+        unknown layers and ValueError for zooms out of range"""
+        if not MIN_ZOOM <= z <= MAX_ZOOM:
+            raise ValueError(f"zoom {z} out of range")
+        layer, directory = self.layer(name, job_directory)
+        key = (directory, z, x, y)
+        with self.lock:
+            png = self.memory.get(key)
+            if png is not None:
+                self.memory.move_to_end(key)
+                metrics.count('tile_memory_hits')
+                return png
+        path = self.path(*key)
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+            metrics.count('tile_disk_hits')
+        except FileNotFoundError:
+            png = self.render(layer, z, x, y)
+            self.store(path, png)
+            metrics.count('tiles_rendered')
+        with self.lock:
+            if key not in self.memory:
+                self.memory[key] = png
+                self.size += len(png)
+            while self.size > self.max_bytes:
+                self.size -= len(self.memory.popitem(last=False)[1])
+        return png
+
+    def render(self, layer, z, x, y):
+        left, top, right, bottom = tile_box(z, x, y)
+        clipped = max(left, 0), max(top, 0), min(right, MAP_WIDTH), min(bottom, MAP_HEIGHT)
+        if clipped[0] >= clipped[2] or clipped[1] >= clipped[3]:
+            return self.empty
+        scale = TILE_SIZE / (right - left)
+        dx, dy = round((clipped[0] - left) * scale), round((clipped[1] - top) * scale)
+        size = (max(round((clipped[2] - left) * scale) - dx, 1), max(round((clipped[3] - top) * scale) - dy, 1))
+        tile = Image.new('RGBA', (TILE_SIZE, TILE_SIZE))
+        tile.paste(layer.render(tuple(int(c) for c in clipped), size), (dx, dy))
+        return self.encode(tile)
+
+    @staticmethod
+    def encode(image):
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', optimize=False, compress_level=1)
+        return buffer.getvalue()
+
+    @staticmethod
+    def store(path, png):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+
+    def build(self, name, zooms=range(MIN_ZOOM, MAX_ZOOM + 1)):
+        """Renders the whole pyramid of a static layer on disk, returns the number of tiles"""
+        layer, directory = self.layer(name)
+        n = 0
+        for z in zooms:
+            xs, ys = tile_range(z)
+            for x in xs:
+                for y in ys:
+                    path = self.path(directory, z, x, y)
+                    if not os.path.exists(path):
+                        self.store(path, self.render(layer, z, x, y))
+                    n += 1
+        return n
+
+
+def campaign_layers(campaign, analyzer):
+    """Returns the colors (province id -> rgb) of the conquest layers of the analyzed countries of campaign, one per
+    country and 'conquests' with all of them"""
+    start_date, end_date = analyzer.heat_map_dates(campaign)
+    layers, combined = {}, {}
+    for country in campaign.countries.values():
+        if not isinstance(getattr(country, 'owned_provinces', None), list):
+            continue
+        layers[f"conquests-{country.tag}"] = colors = analyzer.conquest_colors(country, start_date, end_date)
+        combined.update(colors)
+    layers['conquests'] = combined
+    return layers
+
+
+tile_server = TileServer()
+tile_server.add_layer('map', ProvinceLayer())
+tile_server.add_layer('water', ImageLayer(f"{PROJECT_ROOT}/src/static/images/water_map.png"))
+
+
+def main(args=None):
+    ap = argparse.ArgumentParser(description="Renders the tile pyramid of a static layer on disk")
+    ap.add_argument('layer', choices=sorted(tile_server.layers))
+    ap.add_argument('--zooms', default=f"{MIN_ZOOM},{MAX_ZOOM}", help="comma separated first and last zoom")
+    args = ap.parse_args(args)
+    first, last = (int(z) for z in args.zooms.split(','))
+    print(f"{tile_server.build(args.layer, range(first, last + 1))} tiles of {args.layer} in {tile_server.directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image, ImageDraw, features
+
+from render import rgb_to_int32
+
+FORMATS = ('gif', 'apng', 'webp')
+WHITE, BLACK = (255, 255, 255), (0, 0, 0)
+LEGEND_MARGIN, LEGEND_HEIGHT, FONT_MARGIN = 10, 30, 8
+TRANSPARENT = 255  # palette index reserved for the pixels that didn't change in the deltas of the frames
+
+
+class Timeline:
+    """Frames of the conquests of a country, one every step years from start_date to end_date. Frames are palette
+    images sharing one palette (the colors of the map, white, black and the spectrum of the years) and are drawn in a
+    single index buffer: provinces are sorted by conquest once, and every frame only paints the pixels of the provinces
+    conquered since the previous one, then stamps the legend and the marker of the current year."""
+
+    def __init__(self, renderer, country, start_date, end_date, font, crop_margin=50, resize_ratio=1.0, step=1):
+        self.start_year, self.end_year = start_date.year, end_date.year
+        self.years = list(range(self.start_year, self.end_year + 1, step))
+        if self.years[-1] != self.end_year:
+            self.years.append(self.end_year)
+        self.font = font
+        provinces = sorted((p for p in country.owned_provinces if p.last_conquest <= end_date),
+                           key=lambda p: p.last_conquest)
+        ids = np.array([p.id for p in provinces], dtype=np.int64)
+        self.conquest_years = np.array([max(p.last_conquest.year, self.start_year) for p in provinces], dtype=np.int64)
+        h, w = renderer.labels.shape
+        left, top, right, bottom = renderer.crop_box(ids, crop_margin) if crop_margin >= 0 else (0, 0, w, h)
+        labels = np.asarray(renderer.labels[top:bottom, left:right])
+        colors, self.buffer = np.unique(rgb_to_int32(np.asarray(renderer.base[top:bottom, left:right])),
+                                        return_inverse=True)
+        if len(colors) > 64:
+            raise ValueError(f"the base map has {len(colors)} colors, at most 64 can be animated")
+        self.buffer = self.buffer.reshape(labels.shape).astype(np.uint8)
+        palette = [((c >> 16) & 255, (c >> 8) & 255, c & 255) for c in colors.tolist()] + [WHITE, BLACK]
+        self.white, self.black = len(palette) - 2, len(palette) - 1
+        self.spectrum_offset = len(palette)
+        self.spectrum_size = min(len(range(self.start_year, self.end_year + 1)), TRANSPARENT - len(palette))
+        palette += country.calculate_color_spectrum(n=self.spectrum_size)[:self.spectrum_size]
+        self.palette = bytes(np.array(palette + [BLACK] * (256 - len(palette)), dtype=np.uint8).ravel())
+        # pixels of every province, as slices of the flat positions sorted by province id
+        order = np.argsort(labels, axis=None, kind='stable')
+        sorted_labels = labels.ravel()[order]
+        self.positions = order
+        self.starts = np.searchsorted(sorted_labels, ids, 'left')
+        self.ends = np.searchsorted(sorted_labels, ids, 'right')
+        self.size = tuple(int(round(x * resize_ratio)) for x in (right - left, bottom - top))
+        self.legend = self.draw_legend() if crop_margin >= 0 and right - left > 2 * LEGEND_MARGIN else None
+
+    def __len__(self):
+        return len(self.years)
+
+    def color_index(self, year):
+        fraction = (year - self.start_year) / max(self.end_year - self.start_year, 1)
+        return self.spectrum_offset + min(int(fraction * self.spectrum_size), self.spectrum_size - 1)
+
+    def draw_legend(self):
+        """Returns the legend, as palette indices, and the (left, top) where it goes in the frames"""
+        h, w = self.buffer.shape
+        width = w - 2 * LEGEND_MARGIN
+        legend = Image.new('P', (width + 1, LEGEND_HEIGHT + 1))
+        draw = ImageDraw.Draw(legend)
+        draw.fontmode = '1'
+        # fixme test functioning for conquest after a single year on 3-color countries
+        if self.start_year != self.end_year:
+            for i in range(width):
+                year = self.start_year + i * (self.end_year - self.start_year) / width
+                draw.rectangle([(i, 0), (i + 1, LEGEND_HEIGHT)], fill=self.color_index(year))
+            draw.rectangle([(0, 0), (width, LEGEND_HEIGHT)], outline=self.black, width=1)
+        else:
+            draw.rectangle([(0, 0), (width, LEGEND_HEIGHT)], outline=self.black, width=1, fill=self.spectrum_offset)
+        draw.text((FONT_MARGIN, FONT_MARGIN), str(self.start_year), font=self.font, fill=self.white)
+        draw.text((width - 42, FONT_MARGIN), str(self.end_year), font=self.font, fill=self.white)
+        return np.array(legend), (LEGEND_MARGIN, h - LEGEND_MARGIN - LEGEND_HEIGHT)
+
+    def __iter__(self):
+        """Yields the frames, each one is only valid until the next one is drawn"""
+        flat = self.buffer.reshape(-1)
+        painted = 0
+        for year in self.years:
+            while painted < len(self.conquest_years) and self.conquest_years[painted] <= year:
+                start, end = self.starts[painted], self.ends[painted]
+                flat[self.positions[start:end]] = self.color_index(self.conquest_years[painted])
+                painted += 1
+            frame = Image.frombuffer('P', self.buffer.shape[::-1], self.buffer, 'raw', 'P', 0, 1)
+            if self.legend is not None:
+                legend, (x, y) = self.legend
+                frame = frame.copy()
+                frame.paste(Image.fromarray(legend, 'P'), (x, y))
+                draw = ImageDraw.Draw(frame)
+                marker = x + round((year - self.start_year) / max(self.end_year - self.start_year, 1) *
+                                   (legend.shape[1] - 1))
+                draw.line([(marker, y - 4), (marker, y + LEGEND_HEIGHT)], fill=self.black, width=3)
+            frame.putpalette(self.palette)
+            if frame.size != self.size:
+                frame = frame.resize(self.size, Image.NEAREST)  # palette images can't be interpolated
+            yield frame
+
+
+def deltas(frames):
+    """Yields the first frame whole and then the (image, (x, y)) of the box of the pixels of every frame that changed
+    since the previous one, with the unchanged pixels set to TRANSPARENT"""
+    previous = None
+    for frame in frames:
+        pixels = np.asarray(frame)
+        if previous is None:
+            yield frame, (0, 0)
+        else:
+            changed = pixels != previous
+            rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            if not len(rows):  # a single transparent pixel keeps the timing
+                rows = cols = np.zeros(1, dtype=np.int64)
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            box = slice(top, bottom), slice(left, right)
+            delta = np.where(changed[box], pixels[box], TRANSPARENT).astype(np.uint8)
+            yield Image.fromarray(delta, 'P'), (int(left), int(top))
+        previous = pixels
+
+
+def palette_bytes(frame):
+    return frame.palette.tobytes()[:768].ljust(768, b'\0')
+
+
+def save_all(frames, fp, fmt, **params):
+    """Saves the frames as an animation with Image.save, giving it the frames after the first one as a generator. Frames
+    are copied, since a Timeline draws all of them in the same buffer."""
+    frames = iter(frames)
+    first = next(frames).copy()
+    first.save(fp, format=fmt, save_all=True, append_images=(frame.copy() for frame in frames), **params)
+
+
+def write_gif(frames, fp, duration):
+    """Writes the frames as a looping GIF with a global palette, the one of the first frame. Frames after the first one
+    only store the box of the pixels that changed, which are drawn over the previous frame."""
+    save_all(frames, fp, 'GIF', duration=duration, loop=0, disposal=1, optimize=False)
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def write_apng(frames, fp, duration, count):
+    """Writes the count frames as a looping APNG with the palette of the first one, encoding one delta at a time"""
+    sequence = 0
+    for i, (image, (x, y)) in enumerate(deltas(frames)):
+        w, h = image.size
+        if i == 0:
+            fp.write(b'\x89PNG\r\n\x1a\n')
+            fp.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 3, 0, 0, 0)))
+            fp.write(png_chunk(b'acTL', struct.pack('>II', count, 0)))
+            fp.write(png_chunk(b'PLTE', palette_bytes(image)))
+            fp.write(png_chunk(b'tRNS', b'\xff' * TRANSPARENT + b'\0'))
+        # deltas are blended over the previous frame, so that transparent pixels keep it
+        fp.write(png_chunk(b'fcTL', struct.pack('>IIIIIHHBB', sequence, w, h, x, y, duration, 1000, 0, int(i > 0))))
+        sequence += 1
+        rows = np.asarray(image, dtype=np.uint8)
+        data = zlib.compress(np.hstack([np.zeros((h, 1), dtype=np.uint8), rows]).tobytes(), 6)  # filter 0 rows
+        if i == 0:
+            fp.write(png_chunk(b'IDAT', data))
+        else:
+            fp.write(png_chunk(b'fdAT', struct.pack('>I', sequence) + data))
+            sequence += 1
+    fp.write(png_chunk(b'IEND', b''))
+
+
+def write_webp(frames, fp, duration, quality=80):
+    """Writes the frames as a looping WebP"""
+    if not features.check('webp'):
+        raise ValueError("this build of Pillow doesn't support WebP")
+    save_all(frames, fp, 'WEBP', duration=duration, loop=0, quality=quality)
+
+
+def write(timeline, fp, fmt='gif', duration=100):
+    if fmt == 'gif':
+        write_gif(timeline, fp, duration)
+    elif fmt == 'apng':
+        write_apng(timeline, fp, duration, len(timeline))
+    elif fmt == 'webp':
+        write_webp(timeline, fp, duration)
+    else:
+        raise ValueError(f"unknown format {fmt}, use one of {', '.join(FORMATS)}")
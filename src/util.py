@@ -1,11 +1,11 @@
 import datetime
-from collections import defaultdict
+import logging
 from functools import wraps
 from time import time
 
-from flask import render_template
+from metrics import metrics
 
-func_times = defaultdict(float)
+logger = logging.getLogger(__name__)
 
 
 def get_date(s):
@@ -20,13 +20,13 @@ def calculate_months_diff(d1, d2):
 
 
 def timing(f):
+    """Records the calls of f as a span of the metrics and logs their time"""
     @wraps(f)
     def wrap(*args, **kw):
         ts = time()
-        result = f(*args, **kw)
-        te = time()
-        func_times[f.__name__] += te - ts
-        print(f"{f.__name__} took {te-ts:2.4f}s")
+        with metrics.span(f.__name__):
+            result = f(*args, **kw)
+        logger.debug(f"{f.__name__} took {time() - ts:2.4f}s")
         return result
 
     return wrap
@@ -36,7 +36,7 @@ def yield_info(pairs, reverse=False):
     """Yields items in the dictionary sorting by keys and expanding items grouped in the same keys."""
     items = sorted(((standardize_date(k), v) for k, v in pairs), reverse=reverse)
     for k, v in items:
-        if k[-1] == 's' and isinstance(v, dict) and all(key.isnumeric() for key in v):
+        if k[-1] == 's' and isinstance(v, dict) and all(str(key).isnumeric() for key in v):
             for inner in v.values():
                 yield_info({k[:-1]: inner}, reverse=reverse)
         else:
@@ -47,9 +47,10 @@ def standardize_date(s):
     try:
         date = datetime.datetime.strptime(s, "%Y.%m.%d")
         return date.isoformat()
-    except ValueError:
+    except (ValueError, TypeError):  # not a date or integer key of a container built in memory
         return s
 
 
 def render_template_wrapper(page, **kwargs):
+    from flask import render_template
     return render_template(page, **kwargs), "HTTP/1.1 200 OK", {"Content-Type": "text/html"}
@@ -0,0 +1,89 @@
+import os
+import sys
+from collections import ChainMap
+from collections.abc import Mapping
+from zipfile import ZipFile
+
+from flask_testing import TestCase
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules of src import each other by name, as when they're run from src
+for path in (ROOT, os.path.join(ROOT, 'src')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+class TestConfig:
+    TESTING = True
+
+
+class ServerTestCase(TestCase):
+    """Test case with a client of the app made with TestConfig"""
+
+    def create_app(self):
+        from src import create_app
+        return create_app(TestConfig)
+
+
+META = b"""date=1600.1.1
+save_game="test.eu4"
+player="SWE"
+"""
+# names of keys missing from keys.txt are encoded as unquoted strings, so the sample doesn't depend on the key table
+GAMESTATE = b"""date=1600.1.1
+player="SWE"
+speed=-2
+countries={
+    SWE={
+        human=yes
+        government_rank=2
+        colors={ map_color={ 10 20 30 } }
+        advisor={ id=1 type="philosopher" }
+        advisor={ id=2 type="trader" }
+        advisor={ id=3 type="statesman" }
+        owned_provinces={ 1 2 }
+        treasury=105.250
+        inflation=0.12345
+        empty={ }
+    }
+    DAN={
+        government_rank=1
+        owned_provinces={ 3 }
+        modifier={ }
+    }
+}
+provinces={
+    -1={
+        name="Stockholm"
+        owner="SWE"
+        base_tax=5.000
+        history={
+            owner="DAN"
+            1500.1.1={ owner="SWE" }
+            1600.1.1={ owner="DAN" }
+            1600.1.1={ owner="SWE" }
+        }
+    }
+    -2={ name="Uppland" owner="SWE" base_tax=3.000 }
+    -3={ name="Sj\xe6lland" owner="DAN" }
+}
+trade={ node={ name="baltic" } node={ name="lubeck" } }
+"""
+
+
+def write_save(path, gamestate=GAMESTATE, meta=META, binary=True):
+    """Zips a save with the plaintext gamestate and meta, converted to the binary tokens of ironman saves if binary.
+    The important keys are encoded as keys, so that their sections go through Parser.read_section."""
+    from parser import Parser
+    from text import transcode
+    Parser.init()
+    keys = ChainMap({name: code for code, name in Parser.important_keys.items()}, Parser.keys)
+    with ZipFile(path, 'w') as zf:
+        for name, content in (('meta', meta), ('gamestate', gamestate)):
+            zf.writestr(name, b'EU4bin' + transcode(content, keys) if binary else b'EU4txt\n' + content)
+    return path
+
+
+def to_dict(obj):
+    """Converts containers and lazy objects to plain dictionaries, to compare them"""
+    return {k: to_dict(v) if isinstance(v, Mapping) else v for k, v in obj.items()}
@@ -0,0 +1,42 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import batch
+from tests import write_save
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.save = write_save(os.path.join(self.directory.name, 'save.eu4'))
+
+    def run_quietly(self, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return batch.run(*args, **kwargs)
+
+    def test_run(self):
+        self.assertEqual(self.run_quietly(batch.find_saves([self.directory.name]), workers=1), [])
+        with open(batch.output_path(self.save)) as f:
+            self.assertEqual(json.load(f)['gamestate']['player'], 'SWE')
+        self.assertTrue(batch.is_parsed(self.save))
+
+    def test_missing_save(self):
+        """A save removed after it was found fails alone instead of stopping the batch"""
+        missing = os.path.join(self.directory.name, 'removed.eu4')
+        self.assertEqual(self.run_quietly([missing, self.save], workers=1), [missing])
+        self.assertTrue(os.path.exists(batch.output_path(self.save)))
+        filename, size, _, error = batch.parse_save(missing)
+        self.assertEqual((filename, size), (missing, 0))
+        self.assertIn('FileNotFoundError', error)
+
+    def test_invalid_workers(self):
+        for args in (['-w', '0'], ['--workers', '-1'], ['-t', '0']):
+            with self.assertRaises(SystemExit) as e, contextlib.redirect_stderr(io.StringIO()):
+                batch.main(args + [self.directory.name])
+            self.assertEqual(e.exception.code, 2)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from cache import SaveCache
+from lazy import LazySave
+from tests import to_dict, write_save
+
+
+class SaveCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = SaveCache(directory=os.path.join(self.directory.name, 'cache'))
+        self.filename = write_save(os.path.join(self.directory.name, 'save.eu4'))
+
+    def test_hit_is_not_scanned(self):
+        expected = to_dict(self.cache.load(self.filename))
+        with mock.patch('lazy.scan_object', side_effect=AssertionError("hit scanned again")):
+            save = self.cache.load(self.filename)
+            self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+            self.assertEqual(to_dict(save), expected)
+        self.assertEqual(expected, to_dict(LazySave(self.filename)))
+
+    def test_entry_without_structure(self):
+        self.cache.load(self.filename)
+        path = self.cache.entries()[0][2]
+        for name in LazySave.entries:
+            os.remove(os.path.join(path, f"{name}.2.npz"))
+        self.assertEqual(to_dict(self.cache.load(self.filename)), to_dict(LazySave(self.filename)))
+
+    def test_evicted_entry_is_a_miss(self):
+        key = self.cache.key(self.filename)
+        self.cache.load(self.filename)
+        os.remove(os.path.join(self.cache.directory, key, 'gamestate.bin'))  # evicted while it's being opened
+        self.assertIsNone(self.cache.get(key))
+        shutil.rmtree(os.path.join(self.cache.directory, key))
+        self.assertIsNone(self.cache.get(key))
+        self.cache.load(self.filename)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_eviction(self):
+        self.cache.load(self.filename)
+        self.cache.max_size = 0
+        self.cache.evict()
+        self.assertEqual(self.cache.entries(), [])
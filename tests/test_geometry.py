@@ -0,0 +1,66 @@
+import gzip
+import json
+import os
+import tempfile
+from unittest import mock
+
+import geometry
+from tests import ServerTestCase
+
+
+def square(province_id, left, top, size=100):
+    ring = [[left, top], [left + size, top], [left + size, top + size], [left, top + size], [left, top]]
+    return {'type': 'Feature', 'id': province_id, 'properties': {}, 'geometry': {'type': 'Polygon',
+                                                                                  'coordinates': [ring]}}
+
+
+class GeometryRouteTest(ServerTestCase):
+    """Routes of the province geometry, served from two provinces far from each other"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        source = os.path.join(self.directory.name, 'provinces.geojson')
+        with open(source, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [square(1, 0, 0), square(2, 1000, 1000)]}, f)
+        levels = [geometry.GeometryPayload(source, tolerance=tolerance) for _, tolerance in geometry.LEVELS]
+        patches = (mock.patch.object(geometry, 'levels', levels), mock.patch.object(geometry, 'provinces', levels[-1]))
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def ids(self, response):
+        topology = json.loads(response.data)
+        return sorted(g['properties']['id'] for g in next(iter(topology['objects'].values()))['geometries'])
+
+    def test_payload(self):
+        plain = self.client.get('/geometry/provinces.topojson')
+        self.assert200(plain)
+        self.assertEqual(self.ids(plain), [1, 2])
+        self.assertIsNone(plain.content_encoding)
+        gzipped = self.client.get('/geometry/provinces.topojson', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.content_encoding, 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.data), plain.data)
+        self.assertNotEqual(gzipped.headers['ETag'], plain.headers['ETag'])
+        self.assertIn('Accept-Encoding', gzipped.headers['Vary'])
+        cached = self.client.get('/geometry/provinces.topojson', headers={'If-None-Match': plain.headers['ETag']})
+        self.assertStatus(cached, 304)
+
+    def test_bbox(self):
+        response = self.client.get('/geometry/provinces/4.topojson?bbox=10,10,20,20')
+        self.assert200(response)
+        self.assertEqual(self.ids(response), [1])
+        self.assertEqual(self.ids(self.client.get('/geometry/provinces/4.topojson?bbox=0,0,2000,2000')), [1, 2])
+        self.assertEqual(self.ids(self.client.get('/geometry/provinces/4.topojson')), [1, 2])
+
+    def test_malformed_bbox(self):
+        for bbox in ('', '1,2,3', '1,2,3,4,5', 'a,b,c,d', '1;2;3;4'):
+            self.assert400(self.client.get(f'/geometry/provinces/0.topojson?bbox={bbox}'), bbox)
+
+    def test_non_finite_bbox(self):
+        for bbox in ('nan,0,1,1', '0,0,inf,1', '-inf,0,1,1', '0,-Infinity,1,NaN'):
+            self.assert400(self.client.get(f'/geometry/provinces/0.topojson?bbox={bbox}'), bbox)
+
+    def test_inverted_bbox(self):
+        for bbox in ('10,0,0,10', '0,10,10,0'):
+            self.assert400(self.client.get(f'/geometry/provinces/0.topojson?bbox={bbox}'), bbox)
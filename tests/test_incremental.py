@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+from incremental import IncrementalParser
+from parser import Parser
+from tests import GAMESTATE, to_dict, write_save
+
+# the next autosave: a country and a province changed, a province and a top-level key were added
+CHANGED = GAMESTATE.replace(b'treasury=105.250', b'treasury=99.000') \
+    .replace(b'-2={ name="Uppland" owner="SWE"', b'-2={ name="Uppland" owner="DAN"') \
+    .replace(b'\nprovinces={', b'\nprovinces={\n    -4={ name="Bergen" }') + b'"custom name"=yes\n'
+# top-level keys repeated around empty objects, with the name of their group taken and that aren't strings
+REPEATED = GAMESTATE + b'x={ } x={ id=1 } x={ }\ny=1 ys=2 y=3\nz={ id=1 } z={ } z={ id=2 }\n1=a 1=b\n'
+
+
+class IncrementalParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.first = write_save(os.path.join(self.directory.name, 'first.eu4'))
+        self.second = write_save(os.path.join(self.directory.name, 'second.eu4'), gamestate=CHANGED)
+
+    def assertSameAsFullParse(self, result, filename):
+        self.assertEqual(to_dict(result), to_dict(Parser.from_zip(filename, mode='buffer')))
+
+    def test_first_parse(self):
+        self.assertSameAsFullParse(IncrementalParser().parse(self.first), self.first)
+
+    def test_repeated_keys(self):
+        filename = write_save(os.path.join(self.directory.name, 'repeated.eu4'), gamestate=REPEATED)
+        parser = IncrementalParser()
+        self.assertSameAsFullParse(parser.parse(filename), filename)
+        self.assertSameAsFullParse(parser.parse(filename), filename)  # groups are rebuilt from the previous values
+
+    def test_changed_save(self):
+        parser = IncrementalParser()
+        first = parser.parse(self.first)['gamestate']
+        result = parser.parse(self.second)
+        self.assertSameAsFullParse(result, self.second)
+        self.assertIn('custom name', result['gamestate'])  # string keys are kept whatever the whitelist
+        gamestate = result['gamestate']
+        self.assertIs(gamestate['countries']['DAN'], first['countries']['DAN'])  # unchanged, not decoded again
+        self.assertIs(gamestate['provinces'][-1], first['provinces'][-1])
+        self.assertLess(parser.decoded_bytes, parser.total_bytes / 2)
+
+    def test_same_save(self):
+        parser = IncrementalParser()
+        first = parser.parse(self.first)
+        second = parser.parse(self.first)
+        self.assertEqual(parser.decoded_bytes, 0)
+        self.assertIs(second['gamestate']['countries']['SWE'], first['gamestate']['countries']['SWE'])
+        self.assertSameAsFullParse(second, self.first)
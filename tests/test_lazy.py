@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import lazy
+from lazy import LazyObject, LazySave
+from parser import Parser
+from tests import to_dict, write_save
+from text import transcode
+
+
+class LazySaveTest(unittest.TestCase):
+    """LazySave decodes the same objects as an eager parse, and only the accessed ones"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.binary = write_save(os.path.join(cls.directory.name, 'binary.eu4'))
+        cls.text = write_save(os.path.join(cls.directory.name, 'text.eu4'), binary=False)
+        cls.expected = to_dict(Parser.from_zip(cls.binary, mode='buffer'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_equal_to_parse(self):
+        for lazy_depth in (1, 2, 3):
+            self.assertEqual(to_dict(LazySave(self.binary, lazy_depth=lazy_depth)), self.expected, lazy_depth)
+        self.assertEqual(to_dict(LazySave(self.text)), self.expected)
+
+    def test_objects(self):
+        Parser.init()
+        for text in (b'1 2 a=3 4', b'1=a 1=b', b'x=1 y=2 x=3', b'x=1 xs=2 x=3', b'x=1 x=2 xs=3 x=4',
+                     b'x={ } x={ id=1 } x={ }', b'a={ } b=1 c={ { 1 } { } { 2 } }', b'x={ id=1 } x={ } x={ id=2 }'):
+            view = memoryview(b'EU4bin' + transcode(text, Parser.keys))
+            parser = Parser(stream=None, whitelist=False, mode='buffer')
+            expected = to_dict(parser.decode(view, 6, len(view)))
+            for lazy_depth in (1, 2):
+                obj = LazyObject(view, parser, 6, len(view), lazy_depth=lazy_depth)
+                self.assertEqual(to_dict(obj), expected, (text, lazy_depth))
+
+    def test_lazy(self):
+        save = LazySave(self.binary)
+        with mock.patch.object(lazy.Parser, 'decode', wraps=save['gamestate'].parser.decode) as decode:
+            self.assertEqual(save['gamestate']['speed'], -2)
+            self.assertEqual(decode.call_count, 0)  # scalars and the objects above lazy_depth aren't decoded
+            sweden = save['gamestate']['countries']['SWE']
+            self.assertEqual(sweden['treasury'], 105.25)
+            self.assertEqual(decode.call_count, 1)
+            self.assertIs(save['gamestate']['countries']['SWE'], sweden)
+            self.assertEqual(decode.call_count, 1)
+        self.assertIsNone(save['gamestate']['provinces'].index)
+        self.assertNotIn('empty', sweden)
+        with self.assertRaises(KeyError):
+            save['gamestate']['countries']['NOR']
+
+    def test_structure(self):
+        save = LazySave(self.binary)
+        tokens = save.structure('gamestate')
+        buffers = {name: save.buffers[name] for name in LazySave.entries}
+        with mock.patch.object(lazy, 'scan_object') as scan_object:
+            reused = LazySave(self.binary, buffers=buffers, tokens={'gamestate': tokens})
+            self.assertEqual(to_dict(reused['gamestate']), self.expected['gamestate'])
+        scan_object.assert_not_called()
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from collections import ChainMap
+from unittest import mock
+
+from parser import ClausewitzObjectContainer, Parser, Tape
+from tests import GAMESTATE, to_dict, write_save
+from text import transcode
+
+
+def decode(text, whitelist=False):
+    Parser.init()
+    return to_dict(Parser(stream=None, whitelist=whitelist).decode(memoryview(transcode(text, Parser.keys))))
+
+
+class ParserTest(unittest.TestCase):
+    """The stream and buffer modes, and all the ways of parsing the sections, give the same result"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.binary = write_save(os.path.join(cls.directory.name, 'binary.eu4'))
+        cls.text = write_save(os.path.join(cls.directory.name, 'text.eu4'), binary=False)
+        cls.expected = to_dict(Parser.from_zip(cls.binary, mode='buffer'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_buffer(self):
+        gamestate = self.expected['gamestate']
+        self.assertEqual(gamestate['countries']['SWE']['advisors'][1], {'id': 2, 'type': 'trader'})
+        self.assertEqual(gamestate['provinces'][-3]['name'], 'Sj\xe6lland')
+        self.assertEqual(gamestate['provinces'][-1]['history']['1600.1.1s'][1], {'owner': 'SWE'})
+        self.assertEqual((gamestate['speed'], gamestate['countries']['SWE']['treasury']), (-2, 105.25))
+        self.assertNotIn('empty', gamestate['countries']['SWE'])  # empty objects are dropped
+        self.assertEqual(self.expected['meta']['save_game'], 'test.eu4')
+
+    def test_stream(self):
+        self.assertEqual(to_dict(Parser.from_zip(self.binary, mode='stream')), self.expected)
+
+    def test_stream_small_windows(self):
+        """Sections read a window at a time, with items cut at the end of the windows"""
+        for size in (8, 64, 100):
+            with mock.patch.object(Parser, 'window_size', size):
+                self.assertEqual(to_dict(Parser.from_zip(self.binary, mode='stream')), self.expected, size)
+
+    def test_stream_parallel(self):
+        self.addCleanup(Parser.close_pool)
+        with mock.patch.object(Parser, 'workers', 2), mock.patch.object(Parser, 'window_size', 64):
+            self.assertEqual(to_dict(Parser.from_zip(self.binary, mode='stream')), self.expected)
+
+    def test_text(self):
+        for mode in Parser.modes:
+            self.assertEqual(to_dict(Parser.from_zip(self.text, mode=mode)), self.expected, mode)
+
+    def test_tape(self):
+        Parser.init()
+        content = transcode(GAMESTATE, ChainMap({'countries': 11854}, Parser.keys))
+        tape = Tape.from_buffer(content, keys=ChainMap(Parser.all_keys, Parser.important_keys))
+        rank = tape.find('countries', 'SWE', 'government_rank')
+        self.assertEqual(tape.value(rank), 2)
+        advisors = [v for k, v in tape.items(tape.find('countries', 'SWE')) if tape.value(k) == 'advisor']
+        self.assertEqual(len(advisors), 3)
+        self.assertEqual(bytes(tape.slice(tape.find('speed'))), transcode(b'-2', Parser.keys))
+        with self.assertRaises(KeyError):
+            tape.find('countries', 'NOR')
+        with self.assertRaises(ValueError):
+            Tape.from_buffer(content[:-2])  # unclosed trade object
+
+
+class ContainerTest(unittest.TestCase):
+    """Keys, lists and groups of ClausewitzObjectContainer, built by Parser.decode"""
+
+    def test_pairs_and_lists(self):
+        self.assertEqual(decode(b'a=1 b="x" c={ 1 2 3 }'), {'a': 1, 'b': 'x', 'c': {0: 1, 1: 2, 2: 3}})
+        self.assertEqual(decode(b'1 2 a=3'), {0: 1, 1: 2, 'a': 3})
+        self.assertEqual(decode(b'a={ { 1 } { 2 } }'), {'a': {0: {0: 1}, 1: {0: 2}}})
+
+    def test_groups(self):
+        self.assertEqual(decode(b'advisor={ id=1 } advisor={ id=2 } advisor={ id=3 } a=1'),
+                         {'advisors': {0: {'id': 1}, 1: {'id': 2}, 2: {'id': 3}}, 'a': 1})
+        self.assertEqual(decode(b'x=1 y=2 x=3'), {'xs': {0: 1, 1: 3}, 'y': 2})
+
+    def test_repeated_numbers(self):
+        """Only string keys are grouped, for the others the last value wins"""
+        self.assertEqual(decode(b'1=a 1=b 1500.1.1=c 1500.1.1=d'), {1: 'b', '1500.1.1s': {0: 'c', 1: 'd'}})
+
+    def test_group_name_taken(self):
+        """A repeated key isn't grouped if the object has a key with the name of its group, the last value wins"""
+        self.assertEqual(decode(b'x=1 xs=2 x=3'), {'x': 3, 'xs': 2})
+        self.assertEqual(decode(b'x=1 x=2 xs=3 x=4'), {'x': 4, 'xs': 3})
+
+    def test_empty_objects(self):
+        self.assertEqual(decode(b'a={ } b=1'), {'b': 1})
+        self.assertEqual(decode(b'a={ { 1 } { } { 2 } }'), {'a': {0: {0: 1}, 1: {0: 2}}})
+        self.assertEqual(decode(b'x={ } x={ id=1 } x={ }'), {'xs': {0: {'id': 1}}})
+        self.assertEqual(decode(b'x={ a={ } }'), {})
+
+    def test_append(self):
+        container = ClausewitzObjectContainer()
+        for item in ('a', 1, 'b', 2, 3):
+            container.append(item)
+            if item in (1, 2):
+                container.name_last()
+        self.assertIsNone(container.close())
+        self.assertEqual(container, {'a': 1, 'b': 2, 0: 3})
+        dropped = ClausewitzObjectContainer()
+        dropped.append('a')
+        dropped.append(1)
+        dropped.name_last(drop=True)
+        dropped.close()
+        self.assertEqual(dropped, {})
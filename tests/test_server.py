@@ -0,0 +1,196 @@
+import io
+import os
+import tempfile
+from concurrent.futures import Executor, Future
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+import jobs
+import query
+import server
+import tiles
+from export import Columns
+from parser import Parser
+from tests import GAMESTATE, ServerTestCase, write_save
+
+LAYERS = {'conquests': {'1': [255, 0, 0], '2': [0, 0, 255]}}
+
+
+class InlineExecutor(Executor):
+    """Runs the jobs as soon as they're submitted"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+def process_save(directory):
+    """Stand-in of jobs.process_save that exports the columns of the save but doesn't analyze it"""
+    save = Parser.from_zip(os.path.join(directory, 'save.eu4'), mode='buffer')
+    Columns.from_gamestate(save['gamestate']).save(os.path.join(directory, 'columns'))
+    Image.new('RGB', (4, 4)).save(os.path.join(directory, 'heatmap.png'))
+    jobs.write_json(os.path.join(directory, 'layers.json'), LAYERS)
+    jobs.write_json(os.path.join(directory, 'result.json'), {'player': 'SWE', 'layers': list(LAYERS)})
+    jobs.update_status(directory, 'done')
+
+
+class Renderer:
+    """Stand-in of MapRenderer painting every pixel black"""
+
+    def __init__(self):
+        self.colors = []
+
+    def render(self, colors, box):
+        self.colors.append(colors)
+        left, top, right, bottom = box
+        return np.zeros((bottom - top, right - left, 3), dtype=np.uint8)
+
+
+class ServerTest(ServerTestCase):
+    """Routes of the jobs and of what they made, with a queue in a temporary directory that runs the jobs inline"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.queue = jobs.JobQueue(directory=os.path.join(self.directory.name, 'jobs'))
+        self.queue.executor = InlineExecutor()
+        self.renderer = Renderer()
+        tile_server = tiles.TileServer(directory=os.path.join(self.directory.name, 'tiles'))
+        tile_server.add_layer('water', tiles.tile_server.layers['water'])
+        patches = (mock.patch.object(jobs, 'queue', self.queue), mock.patch.object(jobs, 'process_save', process_save),
+                   mock.patch.object(query, 'indexes', query.CampaignIndexes()),
+                   mock.patch.object(server, 'tile_server', tile_server),
+                   mock.patch.object(tiles.ProvinceLayer, 'renderer', self.renderer))
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.save = write_save(os.path.join(self.directory.name, 'save.eu4'))
+
+    def upload(self, filename=None):
+        with open(filename or self.save, 'rb') as f:
+            return self.client.post('/jobs', data={'save': (f, 'save.eu4')}, content_type='multipart/form-data')
+
+    def job(self):
+        response = self.upload()
+        self.assertIn(response.status_code, (200, 202))
+        return response.json['id']
+
+
+class JobRouteTest(ServerTest):
+
+    def test_upload(self):
+        response = self.upload()
+        self.assertStatus(response, 202)
+        job_id = response.json['id']
+        self.assertTrue(response.headers['Location'].endswith(f'/jobs/{job_id}'))
+        self.assertEqual(self.client.get(f'/jobs/{job_id}').json['state'], 'done')
+        again = self.upload()
+        self.assert200(again)
+        self.assertEqual(again.json['id'], job_id)
+        self.assertEqual(self.client.get(f'/jobs/{job_id}/result.json').json['player'], 'SWE')
+        heatmap = self.client.get(f'/jobs/{job_id}/heatmap.png')
+        self.assert200(heatmap)
+        self.assertEqual(heatmap.mimetype, 'image/png')
+
+    def test_missing_save(self):
+        self.assert400(self.client.post('/jobs', data={}, content_type='multipart/form-data'))
+
+    def test_too_large(self):
+        self.app.config['MAX_CONTENT_LENGTH'] = 16
+        self.assertStatus(self.upload(), 413)
+
+    def test_queue_full(self):
+        self.queue.max_pending = 0
+        response = self.upload()
+        self.assertStatus(response, 503)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_pending(self):
+        with mock.patch.object(jobs, 'process_save', lambda directory: jobs.update_status(directory, 'running')):
+            job_id = self.job()
+        self.assertEqual(self.client.get(f'/jobs/{job_id}').json['state'], 'running')
+        self.assertStatus(self.client.get(f'/jobs/{job_id}/result.json'), 409)
+
+    def test_failed_job_is_retried(self):
+        with mock.patch.object(jobs, 'process_save', lambda directory: jobs.update_status(directory, 'failed')):
+            job_id = self.job()
+        self.assertStatus(self.client.get(f'/jobs/{job_id}/result.json'), 409)
+        self.assertStatus(self.upload(), 202)
+        self.assertEqual(self.client.get(f'/jobs/{job_id}').json['state'], 'done')
+
+    def test_unknown_job(self):
+        for job_id in ('0' * 32, 'not-a-job', '..'):
+            self.assert404(self.client.get(f'/jobs/{job_id}'), job_id)
+            self.assert404(self.client.get(f'/jobs/{job_id}/result.json'), job_id)
+        self.assert404(self.client.get(f'/jobs/{self.job()}/save.eu4'))
+
+
+class CampaignRouteTest(ServerTest):
+
+    def setUp(self):
+        super().setUp()
+        self.url = f'/campaigns/{self.job()}'
+
+    def items(self, response):
+        self.assert200(response)
+        return [item['id'] for item in response.json['items']]
+
+    def test_country(self):
+        response = self.client.get(f'{self.url}/countries/SWE')
+        self.assertEqual((response.json['tag'], response.json['treasury']), ('SWE', 105.25))
+        self.assert404(self.client.get(f'{self.url}/countries/NOR'))
+        self.assert404(self.client.get(f'/campaigns/{"0" * 32}/countries/SWE'))
+
+    def test_country_provinces(self):
+        self.assertEqual(self.items(self.client.get(f'{self.url}/countries/SWE/provinces')), [1, 2])
+        self.assertEqual(self.items(self.client.get(f'{self.url}/countries/SWE/provinces?offset=1&limit=1')), [2])
+        self.assert404(self.client.get(f'{self.url}/countries/NOR/provinces'))
+        for args in ('offset=-1', 'limit=0', 'limit=10001'):
+            self.assert400(self.client.get(f'{self.url}/countries/SWE/provinces?{args}'), args)
+
+    def test_province(self):
+        self.assertEqual(self.client.get(f'{self.url}/provinces/1').json['name'], 'Stockholm')
+        self.assert404(self.client.get(f'{self.url}/provinces/99'))
+
+    def test_conquered_provinces(self):
+        response = self.client.get(f'{self.url}/provinces?from=1449-01-01&to=1550-01-01')
+        self.assertEqual(self.items(response), [1])
+        self.assertEqual(response.json['total'], 1)
+        self.assertEqual(self.items(self.client.get(f'{self.url}/provinces?from=1601-01-01')), [])
+        self.assert400(self.client.get(f'{self.url}/provinces?from=yesterday'))
+
+    def test_rulers(self):
+        self.assert404(self.client.get(f'{self.url}/countries/NOR/rulers'))
+
+    def test_pending_job(self):
+        other = write_save(os.path.join(self.directory.name, 'other.eu4'), gamestate=GAMESTATE + b'speed=1\n')
+        with mock.patch.object(jobs, 'process_save', lambda directory: jobs.update_status(directory, 'running')):
+            job_id = self.upload(other).json['id']
+        self.assert404(self.client.get(f'/campaigns/{job_id}/countries/SWE'))
+        self.assert404(self.client.get(f'/tiles/{job_id}/conquests/0/0/-8.png'))
+
+
+class TileRouteTest(ServerTest):
+
+    def image(self, response):
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'image/png')
+        return Image.open(io.BytesIO(response.data))
+
+    def test_static_layer(self):
+        self.assertEqual(self.image(self.client.get('/tiles/water/0/0/-8.png')).size, (tiles.TILE_SIZE,) * 2)
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, 'tiles', 'water', '0', '0', '-8.png')))
+        self.assert404(self.client.get('/tiles/lakes/0/0/-8.png'))
+        self.assert404(self.client.get(f'/tiles/water/{tiles.MAX_ZOOM + 1}/0/0.png'))
+
+    def test_job_layer(self):
+        job_id = self.job()
+        self.image(self.client.get(f'/tiles/{job_id}/conquests/0/0/-8.png'))
+        self.assertEqual(self.renderer.colors, [{1: (255, 0, 0), 2: (0, 0, 255)}])
+        path = os.path.join(self.queue.job_directory(job_id), 'tiles', 'conquests', '0', '0', '-8.png')
+        self.assertTrue(os.path.exists(path))
+        self.assert404(self.client.get(f'/tiles/{job_id}/conquests-NOR/0/0/-8.png'))
+        self.assert404(self.client.get(f'/tiles/{"0" * 32}/conquests/0/0/-8.png'))
@@ -0,0 +1,53 @@
+import io
+import os
+import tempfile
+import unittest
+
+from parser import Parser
+from tests import GAMESTATE, to_dict, write_save
+from text import convert, to_text, transcode
+
+# escaped quotes and backslashes in strings, other backslashes are kept as they are
+ESCAPES = GAMESTATE + br'''custom_name="The \"Great\" Realm"
+description="a \\ b" path="C:\saves"
+motto="" after="quote"
+'''
+
+
+def parse_text(content):
+    parser = Parser(stream=io.BytesIO(content), whitelist=False, mode='buffer')
+    parser.parse()
+    return to_dict(parser.container)
+
+
+class TextTest(unittest.TestCase):
+
+    def test_escaped_strings(self):
+        d = parse_text(b'EU4txt\n' + ESCAPES)
+        self.assertEqual(d['custom_name'], 'The "Great" Realm')
+        self.assertEqual(d['description'], 'a \\ b')
+        self.assertEqual(d['path'], 'C:\\saves')
+        self.assertEqual((d['motto'], d['after']), ('', 'quote'))
+        self.assertEqual(d['countries']['SWE']['advisors'][2]['type'], 'statesman')
+
+    def test_round_trip(self):
+        """to_text -> convert -> Parser gives back what Parser gives from the binary save"""
+        with tempfile.TemporaryDirectory() as directory:
+            save = write_save(os.path.join(directory, 'save.eu4'), gamestate=ESCAPES)
+            expected = to_dict(Parser.from_zip(save, mode='buffer')['gamestate'])
+            text = os.path.join(directory, 'save.txt')
+            convert(save, text)
+            with open(text, 'rb') as f:
+                content = f.read()
+        self.assertEqual(parse_text(content), expected)
+        self.assertEqual(expected['custom_name'], 'The "Great" Realm')
+        self.assertEqual((expected['description'], expected['path']), ('a \\ b', 'C:\\saves'))
+        Parser(stream=None)
+        self.assertEqual(to_text(b'EU4bin' + transcode(content[7:], Parser.keys)), content)
+
+    def test_long_strings(self):
+        Parser(stream=None)
+        self.assertEqual(len(transcode(b'"' + b'a' * 0xffff + b'"', Parser.keys)), 4 + 0xffff)
+        for token in (b'"' + b'a' * 0x10000 + b'"', b'b' * 0x10000):
+            with self.assertRaisesRegex(ValueError, 'at most 65535'):
+                transcode(b'name=' + token, Parser.keys)
@@ -0,0 +1,66 @@
+import datetime
+import io
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image, ImageFont, ImageSequence, features
+
+from timeline import Timeline, write
+
+
+class Renderer:
+    """Map of 4 provinces in vertical stripes over a grey base"""
+    labels = np.repeat(np.arange(1, 5, dtype=np.int32), 20)[None, :].repeat(60, axis=0)
+    base = np.full((60, 80, 3), 128, dtype=np.uint8)
+
+    def crop_box(self, ids, margin):
+        return 0, 0, 80, 60
+
+
+def province(province_id, year):
+    return SimpleNamespace(id=province_id, last_conquest=datetime.date(year, 1, 1))
+
+
+class TimelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = [np.asarray(frame.convert('RGB')) for frame in self.timeline()]
+
+    @staticmethod
+    def timeline():
+        """Returns a new timeline, since frames are drawn over the ones of the previous iteration"""
+        country = SimpleNamespace(owned_provinces=[province(1, 1444), province(3, 1460), province(4, 1470)],
+                                  calculate_color_spectrum=lambda n: [(255, 10 * i % 256, 0) for i in range(n)])
+        return Timeline(Renderer(), country, datetime.date(1444, 11, 11), datetime.date(1480, 1, 1),
+                        ImageFont.load_default(), crop_margin=0, step=10)
+
+    def read(self, fmt):
+        fp = io.BytesIO()
+        write(self.timeline(), fp, fmt, duration=50)
+        fp.seek(0)
+        return [np.asarray(frame.convert('RGB')) for frame in ImageSequence.Iterator(Image.open(fp))]
+
+    def test_frames(self):
+        self.assertEqual(len(self.frames), 5)  # 1444, 1454, ..., 1480
+        self.assertTrue(any((a != b).any() for a, b in zip(self.frames, self.frames[1:])))
+
+    def test_gif(self):
+        frames = self.read('gif')
+        self.assertEqual(len(frames), len(self.frames))
+        for expected, frame in zip(self.frames, frames):
+            np.testing.assert_array_equal(frame, expected)
+
+    def test_apng(self):
+        for expected, frame in zip(self.frames, self.read('apng'), strict=True):
+            np.testing.assert_array_equal(frame, expected)
+
+    @unittest.skipUnless(features.check('webp'), "Pillow without WebP")
+    def test_webp(self):
+        frames = self.read('webp')
+        self.assertEqual(len(frames), len(self.frames))
+        self.assertEqual(frames[0].shape, self.frames[0].shape)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            write(self.timeline(), io.BytesIO(), 'bmp')